@@ -114,6 +114,36 @@ void restart_variables(){
 	Fortress_Hit = 0;
 }
 
+// Batched step for the python interface: presses the key and advances the
+// game repeat iterations in one call. The symbols and the events of each
+// iteration are written to results[i] (which must have room for repeat
+// results) and the events are restarted after each one (as
+// restart_variables), so that the caller can process the iterations one by
+// one as if they had been separate calls
+void SF_step(int key_value, int repeat, SF_Step_Result* results)
+{
+	int i, j;
+	SF_Step_Result* result;
+	for(i = 0; i < repeat; i++)
+	{
+		set_key(key_value);
+		SF_iteration();
+		result = &results[i];
+		result->mine_hit = Mine_Hit;
+		result->fortress_hit = Fortress_Hit;
+		result->hit_by_mine = Hit_by_Mine;
+		result->hit_by_fortress = Hit_by_Fortress;
+		result->too_fast = Too_Fast;
+		get_symbols();
+		memcpy(result->symbols, symbols, sizeof(symbols));
+		for(j = sizeof(symbols) / sizeof(float); j < SF_STEP_SYMBOLS; j++)
+		{
+			result->symbols[j] = 0;
+		}
+		restart_variables();
+	}
+}
+
 int get_vulner_counter(){
 	return Vulner_Counter;
 }
@@ -24,6 +24,23 @@ void jitter_step2(cairo_t *cr, int step);
 void Reset_Screen();
 
 float* get_symbols();
+
+// Amount of symbols written by SF_step (the last one is always 0, the Python
+// side reads SF_observation_space_sizes['SF-v0'] = 12 game features)
+#define SF_STEP_SYMBOLS 12
+
+// Result of an iteration of SF_step: the symbols after it and its events
+typedef struct
+{
+	float symbols[SF_STEP_SYMBOLS];
+	int mine_hit;
+	int fortress_hit;
+	int hit_by_mine;
+	int hit_by_fortress;
+	int too_fast;
+} SF_Step_Result;
+
+void SF_step(int key_value, int repeat, SF_Step_Result* results);
 void Initialize_Graphics(cairo_t *cr);
 
 unsigned char* update_screen();
@@ -5,7 +5,8 @@ import os
 import ctypes
 import time
 import sys
-import math
+import shutil
+import tempfile
 import logging
 from constants import Constants as CT
 from PIL import Image
@@ -225,6 +226,18 @@ def fig2img ( fig ):
     buf = fig2data ( fig )
     w, h, d = buf.shape
     return Image.frombytes( "RGBA", ( w ,h ), buf.tostring( ) )
+class SFStepResult(ctypes.Structure):
+    """
+    Result of an iteration of the SF_step function of the C++ game
+    (SF_Step_Result in DE_Minimal.h): symbols after it and its events
+    """
+    _fields_ = [('symbols', ctypes.c_float * 12),
+                ('mine_hit', ctypes.c_int),
+                ('fortress_hit', ctypes.c_int),
+                ('hit_by_mine', ctypes.c_int),
+                ('hit_by_fortress', ctypes.c_int),
+                ('too_fast', ctypes.c_int)]
+        
 class SFEnv(gym.Env):
     """
     Space Fortress Gym
@@ -232,9 +245,16 @@ class SFEnv(gym.Env):
     
   
     def __init__(self):
+        self.ep_counter = 0
+        self.reset_variables()
+        
+    def reset_variables(self):
+        """
+        Variables of the Python side of the game that are restarted on every
+        episode
+        """
         self.imgs = []
         self.step_counter = 0
-        self.ep_counter = 0
         self.ep_reward = 0
         self.steps_since_mine_appeared = 1e10
         self.steps_since_last_shot = 1e10
@@ -372,8 +392,19 @@ class SFEnv(gym.Env):
     def is_shot(self, action):
         return action == CT.key_to_action[self.env_name]['Key.space']
         
-    def perform_action(self, action):
+    def perform_action(self, action, repeat = 1):
+        """
+        Presses the key of the action and advances the game. With SF_step
+        the game can advance repeat iterations in a single call to the C++
+        game, which leaves the symbols and the events of each one in
+        step_results, to be processed by step (see Environment.act).
+        """
         key_id = self._action_set[action]
+        if self.SF_step is not None:
+            assert 1 <= repeat <= len(self.step_results), repeat
+            self.SF_step(key_id, repeat, self.step_results)
+            return
+        assert repeat == 1, repeat
         self.set_key(key_id)        
         self.SF_iteration()
 
@@ -391,15 +422,21 @@ class SFEnv(gym.Env):
             pass#is_terminal = True
         return is_terminal
     
-    def step(self, action):
+    def step(self, action, frame = None):
         """
         Performs one action on the environment. Always atomic actions 
         (granularity = 1). This method is agnostic to the
         action_repeat / frameskip that is being used by the agent.
-        """
         
-        #Call the C++ function
-        self.perform_action(action)   
+        params:
+            frame: int, iteration of the last call to perform_action to
+                process instead of performing the action (only with SF_step)
+        """
+        if frame is None:
+            #Call the C++ function
+            self.perform_action(action)
+            frame = 0
+        self.frame = frame
         
         aux = int(self.steps_since_last_shot) # Needed for the double_shoot goal
         reward = self.get_custom_reward(action)
@@ -424,61 +461,116 @@ class SFEnv(gym.Env):
             'steps_since_last_fortress_hit_aux' : self.steps_since_last_fortress_hit_aux
         }
                 
-        self.restart_variables()
+        if self.SF_step is None:
+            self.restart_variables()
+            symbols = None
+        else:
+            # Already restarted and read by SF_step
+            symbols = self.frames['symbols'][frame]
         self.step_counter += 1
         self.ep_reward += reward
-        observation = self.get_observation() 
+        observation = self.get_observation(symbols) 
         return observation, reward, done, info
     
     def scale_observation(self, raw_obs):
-        #print(raw_obs, len(raw_obs))
-        if self.env_name == 'SFC-v0':            
-            #Normalize
-            raw_obs[0] /= self.screen_height    # Ship_Y_Pos
-            raw_obs[1] /= self.screen_width     # Ship_X_Pos
-            raw_obs[2] /= 360                   # Ship_Headings
-            raw_obs[3] /= self.screen_width     # Square_Y
-            raw_obs[4] /= self.screen_height    # Square_X
-            raw_obs[5] = raw_obs[5]                 # Square_steps
-            raw_obs[6] = (raw_obs[6] + 5.) / 10.    # Ship_X_Speed
-            raw_obs[7] = (raw_obs[7] + 5.) / 10.    # Ship_Y_Speed
-        elif self.env_name == 'AIM-v0':
-            #Normalize
-            raw_obs[0] /= 360                   # Ship_Headings
-            raw_obs[1] /= self.screen_width     # Mine_X_Pos
-            raw_obs[2] /= self.screen_height    # Mine_Y_Pos
-        elif self.env_name == 'SF-v0':
-            #Features coming from the C game
-            raw_obs[0]  /= self.screen_height         # Ship_Y_Pos
-            raw_obs[1]  /= self.screen_width          # Ship_X_Pos
-            raw_obs[2]   = (raw_obs[2] + 5.) / 10.    # Ship_Y_Speed
-            raw_obs[3]   = (raw_obs[3] + 5.) / 10.    # Ship_X_Speed 
-            raw_obs[4]  /= 360                        # Ship_Headings
-            raw_obs[5]  /= self.screen_height         # Shell_Y_Pos
-            raw_obs[6]  /= self.screen_width          # Shell_X_Pos
-            raw_obs[7]  /= 360                        # fort_Headings
-            raw_obs[8]  /= 100                        # Missile_Stock
-            raw_obs[9]  /= self.screen_height         # Mine_Y_Pos
-            raw_obs[10] /= self.screen_width          # Mine_X_Pos
-            #Features coming from this environment
-            raw_obs[12] = (raw_obs[12] + 1) / \
-                 (self.config.env.fortress_lifes + 1) # Fortress lives
-            raw_obs[13] = np.tanh(raw_obs[13] * .1)   # Steps_since_last_shot
-            raw_obs[14] = np.tanh(raw_obs[14] * .01)  # Steps since mine appeared
-
+        """
+        Scales the raw observation between 0 and 1 (in the preallocated
+        buffer of the scaled observation) with the factors of compile_features
+        """
+        scaled = self._scaled_obs
+        np.multiply(raw_obs, self._scale, out = scaled)
+        scaled += self._offset
+        if len(self._tanh_ix) > 0:
+            scaled[self._tanh_ix] = np.tanh(scaled[self._tanh_ix])
+        if self.env_name == 'SF-v0':
             # If shells are away from the screen, put them as 0, 0
-            if self.last_shell_coords == (raw_obs[5], raw_obs[6]):
-                raw_obs[5], raw_obs[6] = 0., 0.
+            if self.last_shell_coords == (scaled[5], scaled[6]):
+                scaled[5], scaled[6] = 0., 0.
             else:
-                self.last_shell_coords = (raw_obs[5], raw_obs[6])
+                self.last_shell_coords = (scaled[5], scaled[6])
             # Same with mines
-            if self.last_mine_coords == (raw_obs[9], raw_obs[10]) or \
+            if self.last_mine_coords == (scaled[9], scaled[10]) or \
                 not self.config.env.mines_activated:
-                raw_obs[9], raw_obs[10] = 0., 0.
+                scaled[9], scaled[10] = 0., 0.
             else:
-                self.last_mine_coords = (raw_obs[9], raw_obs[10])                      
-        raw_obs = np.clip(raw_obs, 0, 1)
-        return raw_obs
+                self.last_mine_coords = (scaled[9], scaled[10])
+        np.clip(scaled, 0, 1, out = scaled)
+        return scaled
+    
+    def compile_features(self):
+        """
+        Turns the scaling of each raw feature into factor and offset arrays
+        and the features of define_features into index arrays, so that an
+        observation is scaled and preprocessed with a few vectorized
+        operations into preallocated buffers
+        """
+        n_raw = CT.SF_observation_space_sizes[self.env_name] + 3
+        height, width = self.screen_height, self.screen_width
+        # scaled = raw * scale + offset (and tanh of the tanh_ix ones)
+        if self.env_name == 'SFC-v0':
+            scales = {0 : (1 / height, 0), # Ship_Y_Pos
+                      1 : (1 / width, 0),  # Ship_X_Pos
+                      2 : (1 / 360, 0),    # Ship_Headings
+                      3 : (1 / width, 0),  # Square_Y
+                      4 : (1 / height, 0), # Square_X
+                      6 : (.1, .5),        # Ship_X_Speed
+                      7 : (.1, .5)}        # Ship_Y_Speed
+            tanh_ix = []
+        elif self.env_name == 'AIM-v0':
+            scales = {0 : (1 / 360, 0),    # Ship_Headings
+                      1 : (1 / width, 0),  # Mine_X_Pos
+                      2 : (1 / height, 0)} # Mine_Y_Pos
+            tanh_ix = []
+        elif self.env_name == 'SF-v0':
+            fortress_lifes = self.config.env.fortress_lifes + 1
+            #Features coming from the C game
+            scales = {0  : (1 / height, 0), # Ship_Y_Pos
+                      1  : (1 / width, 0),  # Ship_X_Pos
+                      2  : (.1, .5),        # Ship_Y_Speed
+                      3  : (.1, .5),        # Ship_X_Speed
+                      4  : (1 / 360, 0),    # Ship_Headings
+                      5  : (1 / height, 0), # Shell_Y_Pos
+                      6  : (1 / width, 0),  # Shell_X_Pos
+                      7  : (1 / 360, 0),    # fort_Headings
+                      8  : (1 / 100, 0),    # Missile_Stock
+                      9  : (1 / height, 0), # Mine_Y_Pos
+                      10 : (1 / width, 0),  # Mine_X_Pos
+            #Features coming from this environment
+                      12 : (1 / fortress_lifes, 1 / fortress_lifes), # Fortress lives
+                      13 : (.1, 0),         # Steps_since_last_shot (tanh)
+                      14 : (.01, 0)}        # Steps since mine appeared (tanh)
+            tanh_ix = [13, 14]
+        self._scale = np.ones(n_raw)
+        self._offset = np.zeros(n_raw)
+        for ix, (scale, offset) in scales.items():
+            self._scale[ix], self._offset[ix] = scale, offset
+        self._tanh_ix = np.array(tanh_ix, dtype = int)
+        self._raw_obs = np.zeros(n_raw)
+        self._scaled_obs = np.zeros(n_raw)
+        
+        # Direct features and cyclic ones (sin at out_ix, cos at out_ix + 1)
+        direct_out, direct_raw, cyclic_out, cyclic_raw = [], [], [], []
+        out_ix = 0
+        for raw_name, is_cyclic in self.prep_features:
+            raw_ix = self.raw_features_name_to_ix[raw_name]
+            if is_cyclic:
+                cyclic_out.append(out_ix)
+                cyclic_raw.append(raw_ix)
+                out_ix += 2
+            else:
+                direct_out.append(out_ix)
+                direct_raw.append(raw_ix)
+                out_ix += 1
+        assert out_ix == self.state_size
+        self._direct_out = np.array(direct_out, dtype = int)
+        self._direct_raw = np.array(direct_raw, dtype = int)
+        self._cyclic_sin = np.array(cyclic_out, dtype = int)
+        self._cyclic_cos = self._cyclic_sin + 1
+        self._cyclic_raw = np.array(cyclic_raw, dtype = int)
+        self._cyclic_x = np.zeros(len(cyclic_raw))
+        self._observation = np.zeros(self.state_size)
+        self.feature_name_to_ix = {name: ix for ix, name \
+                                   in enumerate(self.feature_names)}
     
     def define_raw_feature_mappings(self):
         """
@@ -534,14 +626,16 @@ class SFEnv(gym.Env):
         params:
             obs: array of floats
         returns:
-            preprocessed_obs: array of floatss
+            preprocessed_obs: array of floats (preallocated buffer, overwritten
+                by the next observation)
         """        
-        features = []
-        for prep_f in self.prep_fs:
-            packed = prep_f(obs)
-            for feature in packed:
-                features.append(feature)
-        preprocessed_obs = np.array(features)
+        preprocessed_obs = self._observation
+        preprocessed_obs[self._direct_out] = obs[self._direct_raw]
+        if len(self._cyclic_raw) > 0:
+            np.take(obs, self._cyclic_raw, out = self._cyclic_x)
+            sin, cos = aux_decompose_cyclic(self._cyclic_x)
+            preprocessed_obs[self._cyclic_sin] = sin
+            preprocessed_obs[self._cyclic_cos] = cos
         return preprocessed_obs
     
     @property
@@ -569,10 +663,7 @@ class SFEnv(gym.Env):
         self.update_screen()
         
         #Build the image out of that
-        new_frame = self.pretty_screen().contents
-        img = np.ctypeslib.as_array(new_frame)
-        img = np.reshape(img, (self.screen_height, self.screen_width, 2))
-        img = cv2.cvtColor(img, cv2.COLOR_BGR5652RGB)
+        img = cv2.cvtColor(self.screen_view, cv2.COLOR_BGR5652RGB)
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
         #Adds the panel to right of the image
@@ -680,29 +771,49 @@ class SFEnv(gym.Env):
             self.penalize_wrapping = False
             self.currently_wrapping = False
    
-    def get_raw_observation(self):  
+    def read_symbols(self):
+        """
+        returns:
+            view of the features of the C++ game, updated by this call (it is
+            overwritten by the next one)
+        """
+        self.update_symbols()
+        return self.symbols_view
+    
+    def get_raw_observation(self, symbols = None):  
+        """
+        params:
+            symbols: features of the C++ game if they have already been read
+        returns:
+            raw observation (preallocated buffer): the features of the C++
+            game followed by the extra features of this environment
+        """
         # From C++ game
-        game_obs = np.ctypeslib.as_array(self.get_symbols().contents)
-        
+        game_obs = self.read_symbols() if symbols is None else symbols
+        n = len(self.symbols_view)
+        raw_observation = self._raw_obs
+        raw_observation[:n] = game_obs[:n]
         # Extra features
-        extra_obs = np.array([self.fortress_lifes,
-                              self.steps_since_last_shot,
-                              self.steps_since_mine_appeared],
-                              dtype = np.float)
-        
-        # Concat
-        raw_observation = np.hstack([game_obs, extra_obs])
+        raw_observation[n]     = self.fortress_lifes
+        raw_observation[n + 1] = self.steps_since_last_shot
+        raw_observation[n + 2] = self.steps_since_mine_appeared
         return raw_observation
     
-    def get_observation(self):
+    def get_observation(self, symbols = None):
         """
-        Reads the raw vector environment state from the C++ code and
+        Reads the raw vector environment state from the C++ code (unless
+        symbols are given) and
             1) scales it between 0 and 1
             2) checks if the spaceship is wrapping (if that matters)
             3) preprocess the raw vector
+        The preprocessed observation is already between 0 and 1 (the scaled
+        one is clipped and the cyclic features are normalized).
+        
+        returns:
+            a copy of the observation, as the agents keep them
         """
         #Read raw vector
-        raw_obs = self.get_raw_observation()
+        raw_obs = self.get_raw_observation(symbols)
         
         #Scale
         scaled_obs = self.scale_observation(raw_obs)
@@ -714,35 +825,32 @@ class SFEnv(gym.Env):
         #Preprocessing
         preprocessed_obs = self.preprocess_observation(scaled_obs)
         
-        #Make sure that the resulting vector is properly scaled
-        assert (preprocessed_obs >= 0).all() and (preprocessed_obs <= 1).all(),\
-                    str([raw_obs, scaled_obs, preprocessed_obs])
-                    
         # For debugging
         self.current_observation = preprocessed_obs
-        return preprocessed_obs
+        return preprocessed_obs.copy()
     
     def reset(self):
         """
-        Resets the environment. It also loads all the C++ code again so ensure
-        a full fresh restart. This is needed because sometimes the game
-        goes crazy and the features start being corrputed. The game stays
-        corrupted unless a full restart like this is performed. I didn't have time
-        to fix this so the workaround consists in calling this function after
-        every episode :\
+        Resets the environment. Only the state of the game is reinitialized
+        (reset_sf), the loaded library and its functions are kept. Sometimes
+        the game goes crazy and the features start being corrupted, and it
+        stays corrupted unless the library is fully reloaded and configured
+        again, so that is done only when it is detected (is_corrupted).
         
         returns:
             observation: first observation of the new game
         """
-        self.window_active = False
-        self.panel.reset()
-        
-        self.step_counter = 0
-        self.stop_drawing()
-        self.reset_sf()
-        
-        self.imgs = []
-        self.ep_reward = 0
+        if self.is_corrupted():
+            self.reload()
+        else:
+            self.reset_sf()
+            if self.env_name == 'SF-v0':
+                self.restart_variables()
+            self.reset_variables()
+            self.window_active = False
+            self.panel.reset()
+            self.fortress_lifes = self.config.env.fortress_lifes
+            self.ship_lifes = self.config.env.ship_lifes
         if self.env_name == 'SF-v0':
             """
             Special handling of mine and shell cords. When they are not on the
@@ -752,22 +860,45 @@ class SFEnv(gym.Env):
             """
             self.last_shell_coords = (0., 0.)
             self.last_mine_coords = (0., 0.)
-        
-        #Reload game
+        #Get first observation
+        observation = self.get_observation()
+        return observation
+    
+    def is_corrupted(self):
         """
-        Sometimes the game crashes and nothing makes sense anymore. As for now,
-        it is hard to know why and detect how. It is fixed by restarting the
-        game        
+        Detects the corrupted state of the game: features that are not
+        numbers or a spaceship out of the screen
         """
+        game_obs = self.read_symbols()
+        # Only the features that are used (the C array can be shorter)
+        used = [ix for ix in self.raw_features_name_to_ix.values() \
+                                                     if ix < len(game_obs)]
+        if not np.isfinite(game_obs[used]).all():
+            return True
+        if self.env_name == 'AIM-v0':
+            # The spaceship doesn't move
+            return False
+        margin = .1
+        i = self.get_raw_feature(game_obs, 'ship_pos_i') / self.screen_height
+        j = self.get_raw_feature(game_obs, 'ship_pos_j') / self.screen_width
+        return not (-margin <= i <= 1 + margin and -margin <= j <= 1 + margin)
+    
+    def reload(self):
+        """
+        Full restart of the game: the environment is configured again and
+        the C++ game initialized again (with the library already loaded, a
+        private copy of it is not loaded again)
+        """
+        self.logger.warning("Corrupted game, reloading it")
         q_history = self.qpanel.history.copy()
+        ep_counter = self.ep_counter
+        library = self.library
+        self.stop_drawing()
+        self.reset_sf()
         self.__init__()
-        
-        self.configure(self.config)
+        self.configure(self.config, self.private_library, library = library)
+        self.ep_counter = ep_counter
         self.qpanel.history = q_history
-        #Get first observation
-        observation = self.get_observation()
-        return observation
-
 
     def close(self):
         """
@@ -792,8 +923,7 @@ class SFEnv(gym.Env):
         """
         Gets preprocessed feature
         """
-        index = self.feature_names.index(feature_name)
-        return observation[index]
+        return observation[self.feature_name_to_ix[feature_name]]
         
     def get_raw_feature(self, observation, feature_name):
         """
@@ -811,41 +941,41 @@ class SFEnv(gym.Env):
         self.define_raw_feature_mappings()
         
         """
-        These two list are aligned. For each position, there is a feature name
-        (string) and a preprocessing function (lambda x) that extracts it.
+        For each feature there is a (raw feature name, is cyclic) pair in
+        prep_features that says how it is extracted (compile_features turns
+        them into index arrays).
         NB: one feature name, if cyclic, will be decomposed in two different
-        features (_sin and _cos) by its preprocessinf function, so the length
-        of these lists is not necessarily equals to the state space that the
-        agent sees.
+        features (_sin and _cos), so the length of prep_features is not
+        necessarily equals to the state space that the agent sees.
         """
-        prep_fs = []
+        prep_features = []
         feature_names = [] 
       
         if self.env_name == 'AIM-v0':
             ##Irrelevant if WRAPPER / FRICTIONLESS
-            prep_fs += [
-                lambda obs: [self.get_raw_feature(obs, 'mine_pos_i')],
-                lambda obs: [self.get_raw_feature(obs, 'mine_pos_j')]
+            prep_features += [
+                ('mine_pos_i', False),
+                ('mine_pos_j', False)
             ]
             feature_names += ['mine_pos_i', 'mine_pos_j']
         elif not self.is_wrapper:
             # NOT WRAPPER
             if self.env_name == 'SFC-v0':
-                prep_fs += [
-                    lambda obs: [self.get_raw_feature(obs, 'ship_pos_i')],
-                    lambda obs: [self.get_raw_feature(obs, 'ship_pos_j')],
-                    lambda obs: [self.get_raw_feature(obs, 'square_pos_i')],
-                    lambda obs: [self.get_raw_feature(obs, 'square_pos_j')]
+                prep_features += [
+                    ('ship_pos_i', False),
+                    ('ship_pos_j', False),
+                    ('square_pos_i', False),
+                    ('square_pos_j', False)
                 ]
                 feature_names += ['ship_pos_i', 'ship_pos_j','square_pos_i', 'square_pos_j']
           
             elif self.env_name == 'SF-v0':
-                prep_fs += [
-                    lambda obs: [self.get_raw_feature(obs, 'ship_pos_i')],
-                    lambda obs: [self.get_raw_feature(obs, 'ship_pos_j')],
-                    lambda obs: [self.get_raw_feature(obs, 'missile_pos_i')],
-                    lambda obs: [self.get_raw_feature(obs, 'missile_pos_j')]
-#                    lambda obs: [self.get_raw_feature(obs, 'missile_stock')]
+                prep_features += [
+                    ('ship_pos_i', False),
+                    ('ship_pos_j', False),
+                    ('missile_pos_i', False),
+                    ('missile_pos_j', False)
+#                    ('missile_stock', False)
                 ]
                 feature_names += ['ship_pos_i', 'ship_pos_j',
                                   'missile_pos_i', 'missile_pos_j']
@@ -853,11 +983,11 @@ class SFEnv(gym.Env):
         else:
             # WRAPPER
             if self.env_name == 'SFC-v0':
-                prep_fs += [
-                    lambda obs: aux_decompose_cyclic(self.get_raw_feature(obs, 'ship_pos_i')),
-                    lambda obs: aux_decompose_cyclic(self.get_raw_feature(obs, 'ship_pos_j')),
-                    lambda obs: aux_decompose_cyclic(self.get_raw_feature(obs, 'square_pos_i')),
-                    lambda obs: aux_decompose_cyclic(self.get_raw_feature(obs, 'square_pos_j'))
+                prep_features += [
+                    ('ship_pos_i', True),
+                    ('ship_pos_j', True),
+                    ('square_pos_i', True),
+                    ('square_pos_j', True)
                 ]
                 aux = ['ship_pos_i', 'ship_pos_j', 'square_pos_i', 'square_pos_j']
                 for fn in aux:
@@ -865,46 +995,46 @@ class SFEnv(gym.Env):
                 
           
             elif self.env_name == 'SF-v0':
-                prep_fs += [
-                    lambda obs: aux_decompose_cyclic(self.get_raw_feature(obs, 'ship_pos_i')),
-                    lambda obs: aux_decompose_cyclic(self.get_raw_feature(obs, 'ship_pos_j'))
+                prep_features += [
+                    ('ship_pos_i', True),
+                    ('ship_pos_j', True)
                 ]
                 aux = ['ship_pos_i', 'ship_pos_j']
                 for fn in aux:
                     feature_names += [fn + '_sin', fn + '_cos']
-                prep_fs += [
-                    lambda obs: [self.get_raw_feature(obs, 'missile_pos_i')],
-                    lambda obs: [self.get_raw_feature(obs, 'missile_pos_j')]
-#                    lambda obs: [self.get_raw_feature(obs, 'missile_stock')]
+                prep_features += [
+                    ('missile_pos_i', False),
+                    ('missile_pos_j', False)
+#                    ('missile_stock', False)
                 ]
                 feature_names += ['missile_pos_i', 'missile_pos_j']#,
 #                                  'missile_stock']
         if self.is_frictionless and self.env_name != 'AIM-v0':
                 # FRICTIONLESS
-                prep_fs += [
-                    lambda obs: [self.get_raw_feature(obs, 'ship_speed_i')],
-                    lambda obs: [self.get_raw_feature(obs, 'ship_speed_j')]
+                prep_features += [
+                    ('ship_speed_i', False),
+                    ('ship_speed_j', False)
                     ]
                 feature_names += ['ship_speed_i', 'ship_speed_j']          
         if self.env_name == 'SF-v0':
             #Mines don't wrap even if wrapping is activated
             if self.config.env.mines_activated or 1:
                 # Include even if not activated for potential transfer learning
-                prep_fs += [
-                    lambda obs: [self.get_raw_feature(obs, 'mine_pos_i')],
-                    lambda obs: [self.get_raw_feature(obs, 'mine_pos_j')]]
+                prep_features += [
+                    ('mine_pos_i', False),
+                    ('mine_pos_j', False)]
 
                 feature_names += ['mine_pos_i', 'mine_pos_j']
                 if not self.config.env.ez:
                     # Not relevant in ez mode
-                    prep_fs += [
-                    lambda obs: [self.get_raw_feature(obs, 'steps_since_mine_appeared')]
+                    prep_features += [
+                    ('steps_since_mine_appeared', False)
                         ]
                     feature_names += ['steps_since_mine_appeared']
             
-            prep_fs += [         
-                lambda obs: [self.get_raw_feature(obs, 'fortress_lifes')],
-                lambda obs: [self.get_raw_feature(obs, 'steps_since_last_shot')]                             
+            prep_features += [         
+                ('fortress_lifes', False),
+                ('steps_since_last_shot', False)                             
                 ]
             feature_names += ['fortress_lifes', 'steps_since_last_shot']
           
@@ -914,30 +1044,29 @@ class SFEnv(gym.Env):
             #Head doesn't control direction, no heading of the spaceship needed
             pass
         else:
-            f = lambda obs: aux_decompose_cyclic(self.get_raw_feature(obs, 'ship_headings'))
-            prep_fs.append(f)
+            prep_features.append(('ship_headings', True))
             feature_names.append("ship_headings_sin")
             feature_names.append("ship_headings_cos")
-#            f = lambda obs: [self.get_raw_feature(obs, 'ship_headings')]
-#            prep_fs.append(f)
+#            f = ('ship_headings', False)
+#            prep_features.append(f)
 #            feature_names.append('ship_headings')
             if self.env_name == 'SF-v0':
                 pass
                 #Fortress is ALWAYS looking at the spaceship, so this is not needed
-#                f = lambda obs: aux_decompose_cyclic(self.get_raw_feature(obs, 'fort_headings'))
-#                prep_fs.append(f)
+#                f = ('fort_headings', True)
+#                prep_features.append(f)
 #                feature_names.append("fort_headings_sin")
 #                feature_names.append("fort_headings_cos")
         self.feature_names = feature_names
         self.state_size = len(self.feature_names)
-        self.prep_fs = prep_fs
+        self.prep_features = prep_features
     def one_hot_inverse(self, screen):
         #TODO remove function adn adapt HDQN
         return None
     
         
         
-    def configure(self, cnf):
+    def configure(self, cnf, private_library = False, library = None):
         """
         Configure the space fortress environment.
         
@@ -945,8 +1074,15 @@ class SFEnv(gym.Env):
         - Loads the C++ functions from the C++ compiled code
         - Set the appropiate action and state spaces
         - Initializes variables
+        
+        params:
+            private_library: bool, whether to load a private copy of the
+                library. The C++ game keeps its state in global variables,
+                so this is needed to run several games in the same process
+            library: ctypes library already loaded (see reload)
         """
         self.config = cnf
+        self.private_library = private_library
         self.env_name = self.config.env.env_name
        
         
@@ -963,7 +1099,11 @@ class SFEnv(gym.Env):
         # Link the environment to the shared libraries
         lib_dir = os.path.join(libpath, libname)
 #        print(lib_dir)
-        library = ctypes.CDLL(lib_dir)
+        if library is None and private_library:
+            library = load_private_library(lib_dir)
+        elif library is None:
+            library = ctypes.CDLL(lib_dir)
+        self.library = library
         #self.logger.info("LOAD "+ lib_dir)
         
         #self.update = library.update_frame
@@ -982,10 +1122,17 @@ class SFEnv(gym.Env):
         self.is_wrapper = library.is_wrapper()
     
         self.define_features()
+        self.compile_features()
 
         self.get_symbols = library.get_symbols
         n_raw_symbols = CT.SF_observation_space_sizes[self.env_name]
         self.get_symbols.restype = ctypes.POINTER(ctypes.c_float * n_raw_symbols)
+        # get_symbols fills a static array of the game. It is read through a
+        # view created once, so the calls of every step don't need a result
+        self._symbols = self.get_symbols().contents
+        self.symbols_view = np.frombuffer(self._symbols, dtype = np.float32)
+        self.update_symbols = library['get_symbols']
+        self.update_symbols.restype = None
 
         self.SF_iteration = library.SF_iteration
         self.update_screen = library.update_screen
@@ -1005,6 +1152,28 @@ class SFEnv(gym.Env):
             self.get_vulner_counter = library.get_vulner_counter
             self.get_lifes_remaining = library.get_lifes_remaining
             self.restart_variables = library.restart_variables
+        if self.env_name == 'SF-v0' and hasattr(library, 'SF_step'):
+            # Batched step: the events are read from the result of SF_step
+            # instead of calling the C++ game for each of them
+            self.SF_step = library.SF_step
+            self.SF_step.argtypes = [ctypes.c_int, ctypes.c_int,
+                                     ctypes.POINTER(SFStepResult)]
+            self.SF_step.restype = None
+            # A result for each iteration of an action repeated
+            # action_repeat times, also seen as a NumPy structured array
+            n_frames = max(1, int(self.config.env.action_repeat))
+            self.step_results = (SFStepResult * n_frames)()
+            self.frames = np.ctypeslib.as_array(self.step_results)
+            self.frame = 0
+            frames = self.frames
+            self.did_I_hit_mine = lambda: frames['mine_hit'][self.frame]
+            self.was_I_too_fast = lambda: frames['too_fast'][self.frame]
+            self.did_I_hit_fortress = lambda: frames['fortress_hit'][self.frame]
+            self.did_mine_hit_me = lambda: frames['hit_by_mine'][self.frame]
+            self.did_fortress_hit_me = lambda: frames['hit_by_fortress'][self.frame]
+        else:
+            # Library compiled without SF_step
+            self.SF_step = None
             
         sixteen_bit_img_bytes = self.screen_width * self.screen_height * 2
         self.pretty_screen.restype = ctypes.POINTER(ctypes.c_ubyte * sixteen_bit_img_bytes)
@@ -1019,6 +1188,16 @@ class SFEnv(gym.Env):
         self.state_space = gym.spaces.Discrete(self.state_size)
 
         self.init_game()
+        # View of the frame buffer of the full sized render (only available
+        # in libraries compiled with GUI_INTERFACE). The buffer is created
+        # by init_game
+        frame = self.pretty_screen()
+        if frame:
+            self.screen_view = np.frombuffer(frame.contents, dtype = np.uint8)
+            self.screen_view = self.screen_view.reshape(
+                                    (self.screen_height, self.screen_width, 2))
+        else:
+            self.screen_view = None
         self.episode_dir = os.path.join(self.config.gl.logs_dir,
                                         self.config.ag.experiment_name,
                                         self.config.model_name, 
@@ -1037,21 +1216,29 @@ class SFEnv(gym.Env):
         
 
     
-def aux_decompose_cyclic(x):
+def load_private_library(path):
     """
-    Decomposes a cyclic feature into x, y coordinates
-    x : normalized feature (float, scalar)
+    Loads a copy of a shared library, so that it doesn't share its global
+    variables with other loads of the same library (dlopen only loads a
+    file once per process). The copy is deleted once it is loaded
     """
+    directory = tempfile.mkdtemp(prefix = 'sf_lib_')
     try:
-        assert 1 >= x >= 0
-    except Exception as e:
-        assert 1.1 >= x >= -0.1, "X must be normalized (%f)" % x
-        x = np.clip(x, 0, 1)
-
-    sin = math.sin(2 * math.pi * x)
-    cos = math.cos(2 * math.pi * x)
+        copy_path = os.path.join(directory, os.path.basename(path))
+        shutil.copyfile(path, copy_path)
+        library = ctypes.CDLL(copy_path)
+    finally:
+        shutil.rmtree(directory)
+    return library
     
-    norm_sin = (sin + 1) / 2
-    norm_cos = (cos + 1) / 2
-    #return sin, cos
+def aux_decompose_cyclic(x):
+    """
+    Decomposes cyclic features into x, y coordinates
+    x : normalized features (float array)
+    returns:
+        sin and cos of the features, normalized between 0 and 1
+    """
+    angle = 2 * np.pi * np.clip(x, 0, 1)
+    norm_sin = (np.sin(angle) + 1) / 2
+    norm_cos = (np.cos(angle) + 1) / 2
     return norm_sin, norm_cos
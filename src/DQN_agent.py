@@ -25,7 +25,8 @@ class DQNAgent(Agent):
 #        self.memory = memory_type(config      = self.ag,
 #                                   screen_size = self.environment.state_size)       
         self.memory = self.create_memory(config = self.ag,
-                                         size   = self.environment.state_size)
+                                         size   = self.environment.state_size,
+                                         prefix = '')
        
         self.m = Metrics(self.config, self.logs_dir)       
         self.build_dqn()
@@ -40,44 +41,56 @@ class DQNAgent(Agent):
         self.total_steps = self.ag.max_step + self.start_step# + self.ag.memory_size
         self.epsilon = Epsilon()
         self.epsilon.setup(self.ag, self.total_steps)
-        old_obs = self.new_episode()
+        # Observations of the environments (acting is batched over them)
+        environments = self.create_environments(self.ag.n_envs)
+        old_obs = np.array([self.new_episode()] + \
+                           [env.new_game()[0] for env in environments[1:]])
 
         self.m.start_timer()
                 
         iterator = self.get_iterator(start_step  = self.start_step,
                                      total_steps = self.total_steps)
         
+        # The environments are stepped in lockstep, each step of the loop
+        # being the step of one of them. Their next actions are predicted
+        # together every len(environments) steps. Metrics and display
+        # follow the first environment
         for self.step in iterator:
+            i = (self.step - self.start_step) % len(environments)
             # 1. predict
-            action, avg_q = self.predict_next_action(old_obs)    
+            if i == 0:
+                actions, avg_qs = self.predict_next_actions(old_obs)
+            action = actions[i]
        
             # 2. act            
             info = {'is_SF'           : self.m.is_SF,
-                    'display_episode' : self.display_episode,
-                    'avg_q'           : avg_q,
-                    'watch'           : self.gl.watch}
-            new_obs, reward, terminal, info = self.environment.act(action, info)
-            self.process_info(info = info)
-           
-            if self.m.is_SF:
-                self.m.add_act(action)
-            else:
-                self.m.add_act(action, self.environment.gym.one_hot_inverse(new_obs))
-            if self.display_episode:
-                self.console_print(old_obs, action, reward)
+                    'display_episode' : self.display_episode and i == 0,
+                    'avg_q'           : avg_qs[i],
+                    'watch'           : self.gl.watch and i == 0}
+            new_obs, reward, terminal, info = environments[i].act(action, info)
+            if i == 0:
+                self.process_info(info = info)
+                if self.m.is_SF:
+                    self.m.add_act(action)
+                else:
+                    self.m.add_act(action, self.environment.gym.one_hot_inverse(new_obs))
+                if self.display_episode:
+                    self.console_print(old_obs[i], action, reward)
                         
             # 3. observe
-            self.observe(old_obs, action, reward, new_obs, terminal)
-            self.m.increment_external_reward(reward)
+            self.observe(old_obs[i], action, reward, new_obs, terminal, i)
+            if i == 0:
+                self.m.increment_external_reward(reward)
             
-            if terminal:
+            if terminal and i == 0:
                 if self.display_episode:
                     self.console_print_terminal(reward, new_obs)
                 self.m.close_episode()
-                old_obs = self.new_episode()
-             
+                old_obs[i] = self.new_episode()
+            elif terminal:
+                old_obs[i] = environments[i].new_game()[0]
             else:
-                old_obs = new_obs.copy()
+                old_obs[i] = new_obs
            
             if not self.is_testing_time(prefix = ''):
                 continue
@@ -102,27 +115,44 @@ class DQNAgent(Agent):
             self.m.restart()
         self.stop_train_timer()
    
-    def predict_next_action(self, old_obs):
+    def predict_next_actions(self, old_obs):
+        """
+        Epsilon-greedy actions for the observations of all the environments,
+        with one forward pass for all of them
         
+        params:
+            old_obs: float array, one observation per environment
+        returns:
+            actions and maximum Q values (-100 for the random actions)
+        """
         if self.is_ready_to_learn(prefix = ''):
             ep = self.epsilon.steps_value(self.step)
         else:
             ep = 1
         self.m.update_epsilon(value = ep)
-        if random.random() < ep and not self.is_playing():
-            action = random.randrange(self.environment.action_size)
-            avg_q = -100
-        else:
-            feed_dict = {self.s_t: [[old_obs]]}
-#            action = self.q_action.eval(feed_dict)[0]
-            action, avg_q = self.sess.run([self.q_action, self.avg_q], feed_dict)
-            action, avg_q = action[0], avg_q[0]
-        return action, avg_q
+        n = len(old_obs)
+        is_random, is_greedy, actions = self.epsilon_greedy_draws(
+                            '', ep, n, self.environment.action_size)
+        avg_qs = self.get_acting_buffer('', 'avg_qs', n, np.float64)
+        avg_qs[:] = -100.
+        if not is_random.all():
+            network = self.get_numpy_network(prefix = '', step = self.step)
+            if network is not None:
+                q_actions, q_avgs = network.predict(old_obs)
+            else:
+                feed_dict = {self.s_t: old_obs[:, np.newaxis]}
+                q_actions, q_avgs = self.sess.run([self.q_action, self.avg_q],
+                                                  feed_dict)
+            np.copyto(actions, q_actions, where = is_greedy)
+            np.copyto(avg_qs, q_avgs, where = is_greedy)
+        return actions, avg_qs
 
-    def observe(self, old_screen, action, reward, screen, terminal):
+    def observe(self, old_screen, action, reward, screen, terminal,
+                env_idx = 0):
         if self.is_playing():
             return
-        self.memory.add(old_screen, action, reward, screen, terminal)
+        self.memory.add(old_screen, action, reward, screen, terminal,
+                        segment = env_idx)
         self.learn_if_ready(prefix = '')
 
     def q_learning_mini_batch(self):
@@ -130,36 +160,32 @@ class DQNAgent(Agent):
         Samples a batch of experiences from the memory and learns from them
         """
         #Sample
-        (s_t, action, reward, s_t_plus_1, terminal), idx_list, p_list, \
-                                        sum_p, count = self.memory.sample() 
-        
-        #Generate target
-        target_q_t = self.generate_target_q_t(prefix       = '',
-                                              reward       = reward,
-                                              s_t_plus_1   = s_t_plus_1,
-                                              terminal     = terminal)
-        #Prepare data
-        feed_dict = {
-            self.target_q_t: target_q_t,
-            self.action: action,
-            self.s_t: s_t,
-            self.learning_rate_step: self.step,
-        }
+        (s_t, action, reward, s_t_plus_1, terminal, discount), idx_list, \
+                                p_list, sum_p, count = self.memory.sample() 
         
+        #Prepare data (the target is generated in the graph)
+        feed_dict = self.learner_feed_dict(prefix     = '',
+                                           s_t        = s_t,
+                                           action     = action,
+                                           reward     = reward,
+                                           s_t_plus_1 = s_t_plus_1,
+                                           terminal   = terminal,
+                                           discount   = discount)
         
         if self.ag.pmemory:
             beta = (1 - self.epsilon.steps_value(self.step)) + self.epsilon.end
             self.m.beta = beta
-            loss_weight = (np.array(p_list)*count/sum_p)**(-beta)
-            feed_dict[self.loss_weight] = loss_weight
+            feed_dict[self.loss_weight] = self.loss_weights('', p_list, sum_p,
+                                                            count, beta)
         
         #Update parameters
-        _, q_t, td_error, loss = self.sess.run([self.optim, self.q,
-                                                             self.td_error,
-                                             self.loss], feed_dict)
+        fetches = [self.optim, self.q_train, self.td_error, self.loss]
+        if self.ag.pmemory:
+            fetches.append(self.priority)
+        _, q_t, td_error, loss, *priority = self.sess.run(fetches, feed_dict)
 
         if self.ag.pmemory:
-            self.memory.update(idx_list, td_error)
+            self.memory.update_priorities(idx_list, priority[0])
         self.m.total_loss += loss
         self.m.total_q += q_t.mean()        
         self.m.update_count += 1
@@ -210,4 +236,5 @@ class DQNAgent(Agent):
 
         self.load_model()
         self.update_target_q_network(prefix = '')
+        self.create_numpy_network(prefix = '')
         
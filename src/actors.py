@@ -0,0 +1,237 @@
+"""
+Actor processes of the asynchronous (Ape-X like) training mode. The actors
+act on their own environments with NumPy copies of the networks, write
+their transitions to shared replay memories (SharedReplayMemory) and pull
+new weights from a WeightBroadcast every actor_update_step steps, while
+the learner process only updates the networks.
+"""
+import time
+import random
+import numpy as np
+
+import utils
+from environment import Environment
+from goals import create_goals
+from numpy_network import NumpyQNetwork
+from replay_memory import attach_shared_memory, create_shared_memory
+
+
+class WeightBroadcast:
+    """
+    Block of shared memory where the learner publishes the weights of its
+    networks (and some extra values, e.g. epsilons) for the actors. Each
+    actor also publishes its step counters in it.
+
+    The learner is the only writer of the weights. It makes the version odd
+    while it writes them, so an actor that reads an odd version or a
+    different version after copying them just tries again later.
+    """
+    def __init__(self, shapes, n_actors, n_extras = 1, name = None):
+        """
+        params:
+            shapes: dictionary with the shape of each parameter by module,
+                e.g. {'c' : {'l1_w' : [5, 64], ...}, 'mc' : {...}}
+            n_actors: int, amount of actor processes
+            n_extras: int, amount of extra float values
+        """
+        self._args = (shapes, n_actors, n_extras)
+        self.shapes = shapes
+        self._layout = []
+        offset = 0
+        for prefix in sorted(shapes.keys()):
+            for name_ in sorted(shapes[prefix].keys()):
+                size = int(np.prod(shapes[prefix][name_]))
+                self._layout.append((prefix, name_, offset, size))
+                offset += size
+        # version, stop flag | extras | steps of the actors | weights
+        sizes = [2 * 8, n_extras * 8, n_actors * 2 * 8, offset * 4]
+        self.owner = name is None
+        if self.owner:
+            self._shm = create_shared_memory(sum(sizes))
+        else:
+            self._shm = attach_shared_memory(name)
+        self.name = self._shm.name
+        buf = self._shm.buf
+        self._header = np.ndarray(2, dtype = np.int64, buffer = buf)
+        self.extras = np.ndarray(n_extras, dtype = np.float64, buffer = buf,
+                                 offset = sizes[0])
+        # Environment steps and meta-controller steps of each actor
+        self.steps = np.ndarray((n_actors, 2), dtype = np.int64, buffer = buf,
+                                offset = sum(sizes[:2]))
+        self._weights = np.ndarray(offset, dtype = np.float32, buffer = buf,
+                                   offset = sum(sizes[:3]))
+        if self.owner:
+            self._header[:] = 0
+            self.steps[:] = 0
+
+    def __getstate__(self):
+        return {'args' : self._args, 'name' : self.name}
+
+    def __setstate__(self, state):
+        self.__init__(*state['args'], name = state['name'])
+
+    @property
+    def version(self): return int(self._header[0])
+
+    @property
+    def stopped(self): return bool(self._header[1])
+
+    def stop(self):
+        self._header[1] = 1
+
+    def publish(self, weights, extras = ()):
+        """
+        params:
+            weights: dictionary with the parameters (arrays) by module
+            extras: list of floats
+        """
+        self._header[0] += 1
+        for prefix, name, offset, size in self._layout:
+            self._weights[offset:offset + size] = \
+                                    np.ravel(weights[prefix][name])
+        self.extras[:len(extras)] = extras
+        self._header[0] += 1
+
+    def pull(self, last_version):
+        """
+        returns:
+            version, weights by module and extras if there are weights newer
+            than last_version that can be read, None otherwise
+        """
+        version = self.version
+        if version % 2 == 1 or version == last_version:
+            return None
+        weights = {prefix: {} for prefix in self.shapes.keys()}
+        for prefix, name, offset, size in self._layout:
+            weights[prefix][name] = np.reshape(
+                                    self._weights[offset:offset + size].copy(),
+                                    self.shapes[prefix][name])
+        extras = self.extras.copy()
+        if self.version != version:
+            return None
+        return version, weights, extras
+
+    def close(self):
+        for array in ['_header', 'extras', 'steps', '_weights']:
+            setattr(self, array, None)
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
+
+
+class GoalResults:
+    """
+    Sends the results of the goals of an actor to the learner (it is passed
+    to Goal.finished instead of the Metrics object)
+    """
+    def __init__(self, results):
+        self.results = results
+
+    def store_goal_result(self, goal, achieved):
+        self.results.put(('goal', goal.n, achieved, goal.steps_counter))
+
+
+def run_hdqn_actor(actor_id, config, c_memory, mc_memory, broadcast, results,
+                   seed):
+    """
+    Main function of a hDQN actor process. It acts until the learner stops
+    the broadcast.
+
+    params:
+        actor_id: int, slots of the actor in the memories and the broadcast
+        config: Configuration object
+        c_memory, mc_memory: SharedReplayMemory objects
+        broadcast: WeightBroadcast with the weights of 'c' and 'mc' and the
+            epsilon of the meta-controller as extra value
+        results: multiprocessing.Queue where the results of the goals and
+            episodes are sent to the learner
+        seed: int, random seed of the actor
+    """
+    utils.insert_dirs(config.gl.env_dirs)
+    random.seed(seed)
+    np.random.seed(seed)
+    c_memory.set_actor(actor_id)
+    mc_memory.set_actor(actor_id)
+    environment = Environment(config)
+    goals = create_goals(environment, config)
+    goal_results = GoalResults(results)
+    networks = {'c' : NumpyQNetwork(), 'mc' : NumpyQNetwork()}
+
+    def update_networks(version):
+        pulled = broadcast.pull(version)
+        if pulled is None:
+            return version, None
+        version, weights, extras = pulled
+        for prefix, network in networks.items():
+            network.set_weights(weights[prefix])
+        return version, extras[0]
+
+    version, mc_epsilon = -1, None
+    while mc_epsilon is None:
+        if broadcast.stopped:
+            return
+        version, mc_epsilon = update_networks(version)
+        time.sleep(.01)
+
+    obs = environment.new_game()[0]
+    goal = None
+    steps, mc_steps = 0, 0
+    mc_reward, mc_ep_reward, c_ep_reward = 0., 0., 0.
+    while not broadcast.stopped:
+        if goal is None:
+            # Meta-controller sets goal
+            if random.random() < mc_epsilon:
+                n_goal = random.randrange(len(goals))
+            else:
+                n_goal = networks['mc'].predict(obs[np.newaxis])[0][0]
+            goal = goals[n_goal]
+            goal.set_counter += 1
+            goal.achieved_inside_frameskip = False
+            environment.gym.goal_has_changed = True
+            mc_old_obs = obs
+
+        # Controller acts
+        if random.random() < goal.epsilon:
+            action = random.randrange(environment.action_size)
+        else:
+            gs_t = np.concatenate([goal.one_hot, np.ravel(obs)])
+            action = networks['c'].predict(gs_t[np.newaxis])[0][0]
+        info = {'goal_name'       : goal.name,
+                'is_SF'           : environment.env_name == 'SF-v0',
+                'display_episode' : False,
+                'watch'           : False,
+                'avg_q'           : -100,
+                'goal'            : goal}
+        new_obs, ext_reward, terminal, info = environment.act(action, info)
+        new_obs = new_obs.copy()
+        goal.steps_counter += 1
+        goal_achieved = goal.is_achieved(new_obs, action, info)
+        int_reward = 1. if goal_achieved else 0.
+        int_reward -= config.ag.c.intrinsic_time_penalty
+        c_memory.add(obs, action, int_reward, new_obs,
+                     terminal or goal_achieved, goal = goal.n)
+        mc_reward += ext_reward
+        mc_ep_reward += ext_reward
+        c_ep_reward += int_reward
+
+        if terminal or goal_achieved:
+            goal.finished(goal_results, goal_achieved)
+            mc_memory.add(mc_old_obs, goal.n, mc_reward, new_obs, terminal)
+            mc_reward = 0.
+            mc_steps += 1
+            goal = None
+        if terminal:
+            results.put(('episode', mc_ep_reward, c_ep_reward))
+            mc_ep_reward, c_ep_reward = 0., 0.
+            obs = environment.new_game()[0]
+        else:
+            obs = new_obs
+
+        steps += 1
+        broadcast.steps[actor_id] = steps, mc_steps
+        if steps % config.ag.actor_update_step == 0:
+            version, extra = update_networks(version)
+            mc_epsilon = extra if extra is not None else mc_epsilon
+    c_memory.close()
+    mc_memory.close()
+    broadcast.close()
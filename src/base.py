@@ -1,4 +1,5 @@
 import os
+import atexit
 import tensorflow as tf
 import numpy as np
 import random
@@ -9,8 +10,12 @@ from functools import reduce
 
 import utils
 from constants import Constants as CT
+from environment import Environment
 import time
-from replay_memory import PriorityExperienceReplay, OldReplayMemory#, ReplayMemory
+from replay_memory import PriorityExperienceReplay, OldReplayMemory, \
+                          SharedReplayMemory, PrefetchingMemory#, ReplayMemory
+from numpy_network import NumpyQNetwork
+from epsilon import Epsilon
 import cv2
 
 class Agent(object):
@@ -24,6 +29,12 @@ class Agent(object):
         self._saver = None
         self.config = config
         self.output = ''
+        # Arrays and feed dictionaries of the updates, reused on every step
+        self.feed_buffers = {}
+        self.feed_dicts = {}
+        # Random draws of acting (seeded from np.random, so runs stay
+        # repeatable), a Generator can write them in place
+        self.rng = np.random.default_rng(np.random.randint(2 ** 31))
         
      
     def display_environment(self, observation):
@@ -44,6 +55,8 @@ class Agent(object):
     def start_train_timer(self):
         self.t0 = time.time()
     def stop_train_timer(self):
+        self.stop_prefetching()
+        self.flush_memories()
         t1 = time.time()
         seconds = t1 - self.t0        
         filename = 'total_training_seconds.txt'
@@ -79,16 +92,38 @@ class Agent(object):
     def update_target_q_network(self, prefix):
         """
         Copies the parameters of the online network to the offile (target)
-        network
+        network (in one run of the grouped assign op)
         """
-
-        w = self.get(prefix, 'w')
-        target_w_assign_op = self.get(prefix, 'target_w_assign_op')
-        target_w_input = self.get(prefix, 'target_w_input')
-        for name in w.keys():
-            parameters = w[name].eval()
-            target_w_assign_op[name].eval(
-                            {target_w_input[name]: parameters})
+        self.sess.run(self.get(prefix, 'target_w_assign_op'))
+        
+    def create_numpy_network(self, prefix):
+        """
+        NumPy copy of the online network of a module, used to choose the
+        greedy actions without a session run if numpy_inference_step > 0
+        """
+        if self.config.ag.numpy_inference_step > 0:
+            network = NumpyQNetwork()
+        else:
+            network = None
+        self.set(prefix, 'numpy_network', network)
+        self.set(prefix, 'numpy_network_step', None)
+        
+    def get_numpy_network(self, prefix, step):
+        """
+        returns:
+            the NumPy network of a module (None if it is disabled), with the
+            weights of the session refreshed every numpy_inference_step steps
+        """
+        network = self.get(prefix, 'numpy_network')
+        if network is None:
+            return None
+        last_step = self.get(prefix, 'numpy_network_step')
+        if last_step is None or \
+                step - last_step >= self.config.ag.numpy_inference_step:
+            network.set_weights(self.sess.run(self.get(prefix, 'w')))
+            self.set(prefix, 'numpy_network_step', step)
+        return network
+        
     def is_testing_time(self, prefix):
         """
         Testing time means start writting logs to TB
@@ -112,11 +147,71 @@ class Agent(object):
             modified prefix
         """
         return prefix + '_' if prefix != '' else prefix
-    def create_memory(self, config, size):
-        mtype = PriorityExperienceReplay if config.pmemory else OldReplayMemory        
-        memory = mtype(config = config,
-                       screen_size = size) 
+    def create_memory(self, config, size, prefix, store_goals = False,
+                      n_actors = 0):
+        """
+        params:
+            n_actors: int, amount of actor processes that fill the memory
+                (asynchronous mode), 0 if this process fills it
+        """
+        if config.n_actors > 1 and n_actors == 0:
+            # Only this process would write the memory, and it would only
+            # use the slots of the first actor
+            raise ValueError("n_actors > 1 needs actor processes" \
+                             " (asynchronous)")
+        if n_actors > 0:
+            # Memory filled by several actor processes
+            if config.pmemory or config.memory_on_disk:
+                raise ValueError("Shared memories are not compatible with" \
+                                 " pmemory or memory_on_disk")
+            memory = SharedReplayMemory(config = config,
+                                        screen_size = size,
+                                        store_goals = store_goals,
+                                        n_actors = n_actors)
+            atexit.register(memory.close)
+        else:
+            mtype = PriorityExperienceReplay if config.pmemory else OldReplayMemory        
+            if config.memory_on_disk:
+                memory_dir = self.get_memory_dir(prefix)
+                if not os.path.exists(memory_dir):
+                    os.makedirs(memory_dir)
+            else:
+                memory_dir = None
+            # Each environment acting in lockstep writes its own segment
+            memory = mtype(config = config,
+                           screen_size = size,
+                           store_goals = store_goals,
+                           memory_dir = memory_dir,
+                           n_segments = self.config.ag.n_envs) 
+        if memory.restored:
+            name = prefix.upper() if prefix != '' else 'agent'
+            print(" [*] Replay memory of %s restored with %d experiences" \
+                                                      % (name, memory.count))
+        if config.prefetch > 0:
+            # Batches are sampled in the background while the learner runs
+            memory = PrefetchingMemory(memory, queue_size = config.prefetch)
         return memory
+    
+    def get_memory_dir(self, prefix):
+        """
+        Directory of the replay memory files of a module. It is not inside
+        checkpoints_dir2 because that one is deleted on every new checkpoint
+        """
+        return os.path.join(self.config.gl.checkpoints_dir,
+                            self.config.model_name + '_memory',
+                            self.extend_prefix(prefix) + 'memory')
+        
+    def flush_memories(self):
+        prefixes = ['mc', 'c'] if self.m.is_hdqn else ['']
+        for prefix in prefixes:
+            self.get(prefix, 'memory').flush()
+            
+    def stop_prefetching(self):
+        prefixes = ['mc', 'c'] if self.m.is_hdqn else ['']
+        for prefix in prefixes:
+            memory = self.get(prefix, 'memory')
+            if isinstance(memory, PrefetchingMemory):
+                memory.stop()
         
     def is_ready_to_learn(self, prefix):
         """
@@ -132,7 +227,9 @@ class Agent(object):
         start_step = self.get(prefix, "start_step")
         ag = self.get(prefix, 'ag')
        
-        is_ready = current_step > start_step + ag.learn_start and \
+        # A memory restored from disk doesn't need to be filled again
+        learn_start = 0 if memory.restored else ag.learn_start
+        is_ready = current_step > start_step + learn_start and \
                                 memory.count > ag.memory_minimum
         if prefix == 'mc':
             #MC only starts learning if C knows how to achieve goals
@@ -168,6 +265,16 @@ class Agent(object):
         with open(filepath, 'w') as fp:
             fp.write(self.config.to_str())   
             
+    def create_environments(self, n_envs):
+        """
+        Environments to act on in lockstep: the one of the agent and
+        n_envs - 1 new instances (with their own copy of the SF library, the
+        game keeps its state in globals)
+        """
+        return [self.environment] + \
+                    [Environment(self.config, private_library = True) \
+                     for _ in range(n_envs - 1)]
+        
     def new_episode(self):
         """
         Creates a new episode
@@ -344,65 +451,178 @@ class Agent(object):
         # Get the update function
         q_learning_mini_batch = self.get(prefix, 'q_learning_mini_batch')
         
-        if step % cnf.train_frequency == 0:
+        if cnf.replay_ratio > 0:
+            # replay_ratio updates per step, the fractional part is carried
+            # over to the next steps
+            credit = self.get(prefix, 'update_credit') + cnf.replay_ratio
+            updates = int(credit)
+            self.set(prefix, 'update_credit', credit - updates)
+        else:
+            updates = int(step % cnf.train_frequency == 0)
+        for _ in range(updates):
             
             q_learning_mini_batch()
+            if cnf.target_tau > 0:
+                # Soft update of the target network after every update
+                self.sess.run(self.get(prefix, 'target_w_soft_update_op'))
 
-        if step % cnf.target_q_update_step == cnf.target_q_update_step - 1:
+        if cnf.target_tau == 0 and \
+                step % cnf.target_q_update_step == cnf.target_q_update_step - 1:
             self.update_target_q_network(prefix)
             
     
             
-    def generate_target_q_t(self, prefix, reward, s_t_plus_1, terminal, g_t_plus_1 = None):
+    def get_feed_buffer(self, prefix, name, shape, dtype = np.float32):
+        """
+        Preallocated array of a module, so that the inputs of the session
+        are written in place instead of allocated on every step. It is only
+        reallocated if the shape or the type change
+        """
+        key = (prefix, name)
+        buffer = self.feed_buffers.get(key)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype = dtype)
+            self.feed_buffers[key] = buffer
+        return buffer
+    
+    def get_acting_buffer(self, prefix, name, n, dtype = np.float32):
+        """
+        First n items of a preallocated 1D array of a module. The amount of
+        environments acting at once changes, so the array only grows
+        """
+        buffer = self.feed_buffers.get((prefix, name))
+        if buffer is None or len(buffer) < n or buffer.dtype != dtype:
+            buffer = self.get_feed_buffer(prefix, name, (n,), dtype)
+        return buffer[:n]
+    
+    def epsilon_greedy_draws(self, prefix, eps, n, n_choices):
         """
-        Generates y_true that will be used for computing the loss and be
-        able to train.
+        Random part of n epsilon-greedy choices of a module, written in its
+        preallocated buffers
         
         params:
+            eps: float or float array, probability of a random choice
+            n: int, amount of choices
+            n_choices: int, amount of actions (or goals)
+        returns:
+            bool arrays telling which choices are random and which are greedy
+            and int array with the choices, random so far (the greedy ones
+            are to be written by the caller). They are overwritten by the
+            next call
+        """
+        uniform = self.get_acting_buffer(prefix, 'uniform', n, np.float64)
+        is_random = self.get_acting_buffer(prefix, 'is_random', n, np.bool)
+        is_greedy = self.get_acting_buffer(prefix, 'is_greedy', n, np.bool)
+        choices = self.get_acting_buffer(prefix, 'choices', n, np.int64)
+        self.rng.random(out = uniform)
+        np.less(uniform, eps, out = is_random)
+        if self.is_playing():
+            is_random[:] = False
+        np.logical_not(is_random, out = is_greedy)
+        self.rng.random(out = uniform)
+        np.multiply(uniform, n_choices, out = uniform)
+        np.copyto(choices, uniform, casting = 'unsafe')
+        return is_random, is_greedy, choices
+    
+    def benchmark(self, n_updates = 1000):
+        """
+        Measures the updates per second of each module with a memory of
+        random transitions (acting and the environment are left out)
+        
+        params:
+            n_updates: int, timed updates of each module
+        """
+        prefixes = ['mc', 'c'] if self.m.is_hdqn else ['']
+        self.c_learnt = False
+        for prefix in prefixes:
+            ag = self.get(prefix, 'ag')
+            epsilon = Epsilon()
+            epsilon.setup(ag, n_updates)
+            epsilon.start_decaying(0)
+            self.set(prefix, 'epsilon', epsilon)
+            self.set(prefix, 'step', 0)
+            self.set(prefix, 'start_step', 0)
+            self.set(prefix, 'flag_start_training', False)
+        for prefix in prefixes:
+            ag = self.get(prefix, 'ag')
+            memory = self.get(prefix, 'memory')
+            if hasattr(memory, 'set_actor'):
+                memory.set_actor(0)
+            size = self.environment.state_size
+            kwargs = {}
+            for _ in range(min(ag.memory_size, 10 * ag.batch_size)):
+                if prefix == 'c':
+                    kwargs['goal'] = random.randrange(self.goal_size)
+                memory.add(np.random.random(size),
+                           random.randrange(ag.q_output_length),
+                           random.random(), np.random.random(size),
+                           random.random() < .1, **kwargs)
             
+            q_learning_mini_batch = self.get(prefix, 'q_learning_mini_batch')
+            for _ in range(10):
+                # Warm up (e.g. XLA compilation)
+                q_learning_mini_batch()
+            t0 = time.time()
+            for _ in range(n_updates):
+                q_learning_mini_batch()
+            seconds = time.time() - t0
+            name = prefix.upper() if prefix != '' else 'agent'
+            print("%s: %.1f updates/s (xla=%d)" % (name, n_updates / seconds,
+                                                  int(self.config.gl.xla)))
+        self.stop_prefetching()
+        
+    def learner_feed_dict(self, prefix, s_t, action, reward, s_t_plus_1,
+                          terminal, discount, g_t = None):
+        """
+        Feed of a whole update (target, loss and optimizer), so that it is
+        done in a single run of the session. The dictionary (and the arrays
+        of the concatenations) are reused by the next call.
+        
+        params:
+            discount: float array, discount applied to the value of
+                s_t_plus_1 (gamma^n for n-step transitions)
+            g_t: goals of the transitions (only for the controller)
         """
         ag = self.get(prefix, 'ag')
-
-        target_s_t = self.get(prefix, 'target_s_t')
         if ag.double_q:
-            #DOUBLE Q LEARNING
-            #Get object references
-            q_action = self.get(prefix, 'q_action')
-            s_t = self.get(prefix, 's_t')
-            target_q_with_idx = self.get(prefix, 'target_q_with_idx')
-            target_q_idx = self.get(prefix, 'target_q_idx')
-            
-            #Predict action with ONLINE Q network
-            q_action_input = {s_t: s_t_plus_1}
-            if prefix == 'c': #Add goal to input
-                q_action_input[self.c_g_t] = g_t_plus_1
-            pred_action = q_action.eval(q_action_input)
-            
-            #Estimate value of predicted action with TARGET Q network
-            target_q_with_idx_input = {
-                    target_s_t: s_t_plus_1,
-                    target_q_idx: [[idx, pred_a] for idx, pred_a in \
-                                                       enumerate(pred_action)]}
-            if prefix == 'c': #Add goal to input
-                target_q_with_idx_input[self.c_target_g_t] = g_t_plus_1
-            q_t_plus_1_with_pred_action = target_q_with_idx.eval(target_q_with_idx_input)
-       
-            terminal, reward = np.array(terminal), np.array(reward)
-            target_q_t = (1. - terminal) * ag.discount * \
-                                        q_t_plus_1_with_pred_action + reward
+            # The online network also predicts the actions of the next states
+            online_s_t = self.get_feed_buffer(prefix, 's_t',
+                                              (2 * len(s_t),) + s_t.shape[1:],
+                                              s_t.dtype)
+            np.concatenate([s_t, s_t_plus_1], out = online_s_t)
         else:
-            # No double
-            target_q = self.get(prefix, 'target_q')
-            terminal = np.array(terminal) + 0.
-            target_q_input = {target_s_t: s_t_plus_1}
-            if prefix == 'c':
-                target_q_input[self.c_target_g_t] = g_t_plus_1
-            q_t_plus_1 = target_q.eval(target_q_input)
+            online_s_t = s_t
+        feed_dict = self.feed_dicts.setdefault(prefix, {})
+        feed_dict[self.get(prefix, 's_t')] = online_s_t
+        feed_dict[self.get(prefix, 'action')] = action
+        feed_dict[self.get(prefix, 'target_s_t')] = s_t_plus_1
+        feed_dict[self.get(prefix, 'target_reward')] = reward
+        feed_dict[self.get(prefix, 'target_terminal')] = terminal
+        feed_dict[self.get(prefix, 'target_discount')] = discount
+        feed_dict[self.get(prefix, 'learning_rate_step')] = \
+                                                    self.get(prefix, 'step')
+        if prefix == 'c':
+            # The goal doesn't change within a transition
+            if ag.double_q:
+                online_g_t = self.get_feed_buffer(prefix, 'online_g_t',
+                                                  (2 * len(g_t),) + g_t.shape[1:],
+                                                  g_t.dtype)
+                np.concatenate([g_t, g_t], out = online_g_t)
+            else:
+                online_g_t = g_t
+            feed_dict[self.c_g_t] = online_g_t
+            feed_dict[self.c_target_g_t] = g_t
+        return feed_dict
     
-            max_q_t_plus_1 = np.max(q_t_plus_1, axis=1)
-            target_q_t = (1. - terminal) * ag.discount * max_q_t_plus_1 + reward
-        
-        return target_q_t        
+    def loss_weights(self, prefix, p_list, sum_p, count, beta):
+        """
+        Importance sampling weights of a batch of the prioritized memory,
+        (p * count / sum_p) ^ -beta, computed in place
+        """
+        weights = self.get_feed_buffer(prefix, 'loss_weight', (len(p_list),))
+        np.multiply(p_list, count / sum_p, out = weights)
+        np.power(weights, -beta, out = weights)
+        return weights
     
     def add_dueling(self, prefix, input_layer):
         """
@@ -496,10 +716,6 @@ class Agent(object):
                                         name = extended_prefix + 'loss_weight')
                 self.set(prefix, 'loss_weight', loss_weight)
                 
-            target_q_t = tf.placeholder('float32', [None],
-                                         name = extended_prefix + 'target_q_t')
-            self.set(prefix, 'target_q_t', target_q_t)
-            
             action = tf.placeholder('int64', [None],
                                     name = extended_prefix + 'action')
             self.set(prefix, 'action', action)
@@ -509,14 +725,54 @@ class Agent(object):
                            1.0, 0.0, name = extended_prefix + 'action_one_hot')
             self.set(prefix, 'action_one_hot', action_one_hot)
             
-           
-            q = self.get(prefix, 'q')
+            # With double Q learning the online network is fed the states
+            # followed by the next states (see learner_feed_dict), so both
+            # halves are computed in the same run
+            q_all = self.get(prefix, 'q')
+            batch_size = tf.shape(action)[0]
+            q = q_all[:batch_size]
+            self.set(prefix, 'q_train', q)
+            
+            # Target computed in the graph from the sampled transitions
+            reward = tf.placeholder('float32', [None],
+                                    name = extended_prefix + 'target_reward')
+            self.set(prefix, 'target_reward', reward)
+            terminal = tf.placeholder('float32', [None],
+                                      name = extended_prefix + 'target_terminal')
+            self.set(prefix, 'target_terminal', terminal)
+            # gamma^n for n-step transitions
+            discount = tf.placeholder('float32', [None],
+                                      name = extended_prefix + 'target_discount')
+            self.set(prefix, 'target_discount', discount)
+            target_q = self.get(prefix, 'target_q')
+            if ag.double_q:
+                #DOUBLE Q LEARNING
+                # Action predicted by the ONLINE network, valued by the TARGET
+                pred_action = tf.argmax(q_all[batch_size:], axis = 1)
+                q_t_plus_1 = tf.reduce_sum(target_q * tf.one_hot(pred_action,
+                                                         action_space_size),
+                                           reduction_indices = 1)
+            else:
+                q_t_plus_1 = tf.reduce_max(target_q, axis = 1)
+            target_q_t = tf.stop_gradient(
+                            (1. - terminal) * discount * q_t_plus_1 + reward,
+                            name = extended_prefix + 'target_q_t')
+            self.set(prefix, 'target_q_t', target_q_t)
+            
             q_acted = tf.reduce_sum(q * action_one_hot,
                                     reduction_indices = 1,
                                     name = extended_prefix + 'q_acted')
             
             td_error = tf.abs(target_q_t - q_acted)
             self.set(prefix, 'td_error', td_error)
+            
+            if ag.pmemory:
+                # New priorities of the sampled transitions, fetched along
+                # with the update
+                memory = self.get(prefix, 'memory')
+                priority = tf.pow(td_error + memory.e, memory.a,
+                                  name = extended_prefix + 'priority')
+                self.set(prefix, 'priority', priority)
                         
             if ag.pmemory:
                 loss_function = utils.weighted_huber_loss
@@ -552,6 +808,8 @@ class Agent(object):
                                 momentum      = 0.95,
                                 epsilon       = 0.01).minimize(loss)
             self.set(prefix, 'optim', optim)
+            # Updates owed to the module when replay_ratio is fractional
+            self.set(prefix, 'update_credit', 0.)
             
             
     def send_some_metrics(self, prefix):
@@ -623,9 +881,6 @@ class Agent(object):
         aux3 = aux1 + '_w'                               # mc_target_w
         aux4 = aux1 + '_q'                               # mc_target_q
         aux5 = 'w' if extended_prefix == '' else extended_prefix + 'w'     # mc_w
-        aux6 = aux4 + '_idx'                             # mc_target_q_idx        
-        aux7 = aux4 + '_with_idx'                        # mc_target_q_with_idx
-        aux8 = extended_prefix + 'outputs_idx'           # mc_outputs_idx
         
         target_w = {}
         
@@ -671,26 +926,23 @@ class Agent(object):
             
             setattr(self, aux2, target_s_t)
             setattr(self, aux4, target_q)
-            if ag.double_q:               
-                #Double DQN                  
-                target_q_idx = tf.placeholder('int32', [None, None], aux8)
-                target_q_with_idx = tf.gather_nd(target_q, target_q_idx)
-                setattr(self, aux6, target_q_idx)
-                setattr(self, aux7, target_q_with_idx)
     
         #self.show_attrs()
         with tf.variable_scope(extended_prefix + 'pred_to_target'):
-            target_w_input = {}
-            target_w_assign_op = {}
+            # All the parameters are copied inside the session at once
             w = getattr(self, aux5)
-            for name in w.keys():
-                target_w_input[name] = tf.placeholder(
-                               'float32',
-                               target_w[name].get_shape().as_list(),
-                               name=name)
-                target_w_assign_op[name] = target_w[name].assign(
-                                                value = target_w_input[name])
-        setattr(self, aux3 + "_input", target_w_input)
+            target_w_assign_op = tf.group(
+                        *[target_w[name].assign(w[name]) for name in w.keys()],
+                        name = extended_prefix + 'target_w_assign_op')
+            if ag.target_tau > 0:
+                # Polyak averaging: target = (1 - tau) * target + tau * online
+                tau = ag.target_tau
+                target_w_soft_update_op = tf.group(
+                        *[target_w[name].assign(
+                                (1 - tau) * target_w[name] + tau * w[name])
+                          for name in w.keys()],
+                        name = extended_prefix + 'target_w_soft_update_op')
+                setattr(self, aux3 + "_soft_update_op", target_w_soft_update_op)
         setattr(self, aux3 + "_assign_op", target_w_assign_op)
         
         
@@ -699,6 +951,7 @@ class Agent(object):
         if not os.path.exists(self.checkpoints_dir):
             os.makedirs(self.checkpoints_dir)
         self.saver.save(self.sess, self.checkpoints_dir, global_step=step)
+        self.flush_memories()
         msg = "\nSaved checkpoint step=%d at %s" % (step, self.checkpoints_dir2)
         print(msg)
 
@@ -135,6 +135,13 @@ class GlobalSettings(GenericSettings):
         self.gpu_fraction = '1/1'
         self.random_seed = 7
         self.watch = 0
+        # Compile the graph with XLA JIT
+        self.xla = 0
+        # Threads of the TF session (0: TF default, or the share of cores of
+        # the run with parallel > 0) and pinning of the run to its cores
+        self.intra_op_threads = 0
+        self.inter_op_threads = 0
+        self.pin_cpus = 0
         self.root_dir = os.path.normpath(os.path.join(os.path.dirname(
                                         os.path.realpath(__file__)), ".."))
         self.environments_dir = os.path.join(self.root_dir, 'Environments')
@@ -235,13 +242,26 @@ class DQNSettings(AgentSettings):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.agent_type = 'dqn'
+        # Environment instances stepped in lockstep (their actions are
+        # predicted in a single forward pass). Each one writes its own
+        # segment of the replay memory
+        self.n_envs = 1
+        # If > 0, actions are chosen with a NumPy copy of the network whose
+        # weights are refreshed every numpy_inference_step steps
+        self.numpy_inference_step = 0
         self.memory_size = int(1e6)
         
         self.batch_size = 32
         
         # Rewards discount (gamma)
         self.discount = 0.99
+        # Steps of the returns used as targets (n-step Q learning)
+        self.n_step = 1
         self.target_q_update_step = 1 * self.scale
+        # If > 0 the target network is updated after every update with Polyak
+        # averaging (target = (1 - tau) * target + tau * online) instead of
+        # being copied every target_q_update_step
+        self.target_tau = 0
         self.learning_rate = 5*1e-4
         self.learning_rate_minimum = 2*1e-4
         self.learning_rate_decay = 0.96
@@ -258,6 +278,9 @@ class DQNSettings(AgentSettings):
         self.history_length = 1 # X observation fed by step. Not tested for x > 1
         # Frequency for making update weights
         self.train_frequency = 4
+        # Updates per step (e.g. 0.25, 1 or 4), used instead of
+        # train_frequency if > 0
+        self.replay_ratio = 0
         # Don't update weights if this amount of steps have been taken
         self.learn_start = 10000
         
@@ -274,6 +297,20 @@ class DQNSettings(AgentSettings):
         
         # Don't update weights if memory is less big than this
         self.memory_minimum = 10000
+        # Keep the replay memory in files (np.memmap) next to the checkpoints
+        # so that it is restored when training is resumed
+        self.memory_on_disk = 0
+        # Storage type of the observations in the replay memory: 'float32',
+        # 'float16', or 'uint16'/'uint8' (fixed-point, only for features in
+        # [0, 1]). None means the default of the memory type
+        self.memory_precision = None
+        # Amount of actor processes filling the replay memory (asynchronous
+        # mode). The memory is in shared memory, each actor having its own
+        # slots
+        self.n_actors = 1
+        # Amount of batches sampled in advance by a background thread while
+        # the network is updated. 0 means sampling in the update itself
+        self.prefetch = 0
         
         # Whether to use DQN extensions or not
         self.dueling = 0
@@ -295,6 +332,16 @@ class hDQNSettings(AgentSettings):
         self.c = ControllerSettings(*args, **kwargs)
         
         self.goal_group = 1 
+        # Environment instances stepped in lockstep, each one writing its
+        # own segment of the replay memories
+        self.n_envs = 1
+        # If > 0, goals and actions are chosen with NumPy copies of the
+        # networks whose weights are refreshed every numpy_inference_step steps
+        self.numpy_inference_step = 0
+        # Actor processes act while this process learns (Ape-X like). The
+        # actors pull the weights every actor_update_step steps
+        self.asynchronous = 0
+        self.actor_update_step = 400
         
         if 'ep_start' in args:
             self.mc.update({'ep_start' : args['ep_start']})
@@ -333,11 +380,13 @@ class ControllerSettings(AgentSettings):
         self.batch_size = 32
         
         self.target_q_update_step = 1 * self.scale
+        self.target_tau = 0
         self.learning_rate = 5*1e-4
         self.learning_rate_minimum = 2*1e-4
         self.learning_rate_decay = 0.96
         self.learning_rate_decay_step = 5 * self.scale
         self.discount = 0.99
+        self.n_step = 1
        
         self.architecture = [512, 512]
         self.architecture_duel = [128]
@@ -350,6 +399,7 @@ class ControllerSettings(AgentSettings):
         
         
         self.train_frequency = 4
+        self.replay_ratio = 0
         #Visualize weights initialization in the histogram
         self.learn_start = 10000
         # C needs to reach `learnt_threshold` of its goals so that MC starts learning
@@ -359,6 +409,10 @@ class ControllerSettings(AgentSettings):
         self.goal_attempts_list_len = 1000
     
         self.memory_minimum = 10000
+        self.memory_on_disk = 0
+        self.memory_precision = None
+        self.n_actors = 1
+        self.prefetch = 0
         
 
     
@@ -377,16 +431,19 @@ class MetaControllerSettings(AgentSettings):
         self.batch_size = 32    
         
         self.target_q_update_step = 1 * self.scale
+        self.target_tau = 0
         self.learning_rate = 5*1e-4
         self.learning_rate_minimum = 2*1e-4
         self.learning_rate_decay = 0.94
         self.learning_rate_decay_step = 5 * self.scale
         self.discount = 0.99
+        self.n_step = 1
         self.ep_end = 0.05
         self.ep_start = 1.
         self.ep_end_t_perc = .65
         
         self.train_frequency = 4
+        self.replay_ratio = 0
         self.learn_start = 1000
         
         self.architecture = [512, 512]
@@ -400,6 +457,10 @@ class MetaControllerSettings(AgentSettings):
 
         self.prefix = 'mc'
         self.memory_minimum = 1000
+        self.memory_on_disk = 0
+        self.memory_precision = None
+        self.n_actors = 1
+        self.prefetch = 0
         
     
 class EnvironmentSettings(GenericSettings):
@@ -9,10 +9,19 @@ class Environment():
     https://github.com/devsisters/DQN-tensorflow/blob/master/dqn/environment.py
     but needs readaptation.
     """
-    def __init__(self, cnf):
+    def __init__(self, cnf, private_library = False):
+        """
+        params:
+            private_library: bool, whether a SF environment should load its
+                own copy of the game library (needed when several SF
+                environments act in the same process)
+        """
         self.env_name = cnf.env.env_name
         self.gym = self.load_gym()
-        self.gym.configure(cnf)
+        if private_library and self.env_name in CT.SF_envs:
+            self.gym.configure(cnf, private_library = True)
+        else:
+            self.gym.configure(cnf)
         self.action_size = self.gym.action_space.n
         self.state_size = self.gym.state_space.n
         self.action_repeat = cnf.env.action_repeat
@@ -58,10 +67,18 @@ class Environment():
         return self.screen, 0., 0., self.terminal
 
 
-    def _step(self, action):
+    def _step(self, action, frame = None):
+        """
+        params:
+            frame: int, iteration of the last batched step of the SF game to
+                process instead of performing the action (see act)
+        """
         self.step_counter += 1
-        self._screen, self.reward, self.terminal, self.info = \
-                                                    self.gym.step(action)
+        if frame is None:
+            step = self.gym.step(action)
+        else:
+            step = self.gym.step(action, frame = frame)
+        self._screen, self.reward, self.terminal, self.info = step
         self.info['action_repeat'] = self.action_repeat
         self.info['step_counter'] = self.step_counter
         
@@ -107,10 +124,19 @@ class Environment():
             if CT.action_to_sf[self.env_name][action] == \
                                             CT.key_to_sf['Key.space']:
                 repeat = 1
+        # The SF game can play the repeated action in a single call and leave
+        # each iteration to be processed here, unless the skipped frames have
+        # to be rendered
+        batched = self.env_name == 'SF-v0' and repeat > 1 and \
+                  self.gym.SF_step is not None and \
+                  not (info.get('display_episode') or info.get('watch'))
+        if batched:
+            self.gym.perform_action(action, repeat)
           
         # Perform the action repeat times            
         for i in range(repeat):            
-            self._step(action) # Perform the action
+            # Perform the action (or process its i-th iteration)
+            self._step(action, frame = i if batched else None)
             cumulated_reward = cumulated_reward + self.reward
             should_break = self.extra_checks(i, repeat, info, action)                
             if should_break:
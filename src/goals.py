@@ -48,12 +48,17 @@ class Goal(metaclass = ABCMeta):
 #        result = self._epsilon.successes_value(
 #                            attempts = self.set_counter,
 #                            successes = self.achieved_counter)
+        self.update_success_rate()
+        return 1 - min(self.success_rate, .99)
+
+    def update_success_rate(self):
+        """
+        Computes the rate of achievement of the last attempts
+        """
         try:
             self.success_rate = sum(self.last_attempts) / len(self.last_attempts)
         except ZeroDivisionError:
             self.success_rate = 0
-        
-        return 1 - min(self.success_rate, .99)
 
     
     def setup_one_hot(self, length):
@@ -374,6 +379,36 @@ class SFGoal(Goal):
             
 
  
+def create_goals(environment, config):
+    """
+    Goals of the hDQN agent for an environment
+
+    params:
+        environment: Environment object
+        config: Configuration object
+    returns:
+        dictionary with the Goal objects by number
+    """
+    if environment.env_name in CT.MDP_envs:
+        goal_size = environment.state_size
+        goals = {}
+        for n in range(goal_size):
+            goal_name = "g" + str(n)
+            goal = MDPGoal(n, goal_name, config.ag.c)
+            goal.setup_one_hot(goal_size)
+            goals[goal.n] = goal
+    elif environment.env_name in CT.SF_envs:
+        #Space Fortress
+        goal_names = \
+            CT.goal_groups[environment.env_name][config.ag.goal_group]
+        goals = generate_SF_goals(
+                environment = environment,
+                goal_names  = goal_names,
+                config      = config.ag.c)
+    else:
+        raise ValueError("No prior goals for " + environment.env_name)
+    return goals
+
 def generate_SF_goals(environment, goal_names, config = None):
     """adwx
     Gnerate Goal objects
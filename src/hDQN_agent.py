@@ -1,5 +1,9 @@
 import os
+import copy
+import queue
+import time
 import random
+import multiprocessing
 import numpy as np
 from functools import reduce
 import tensorflow as tf
@@ -7,8 +11,10 @@ import tensorflow as tf
 
 import base
 from replay_memory import PriorityExperienceReplay, OldReplayMemory#, ReplayMemory
+from replay_memory import PrefetchingMemory
+import actors
 import utils
-from goals import MDPGoal, generate_SF_goals
+from goals import create_goals
 from metrics import Metrics
 from constants import Constants as CT
 from epsilon import Epsilon
@@ -30,11 +36,21 @@ class HDQNAgent(base.Agent):
         self.mc_ag.update({"q_output_length" : self.goal_size}, add = True)
         self.c_ag.update({"q_output_length" : self.environment.action_size}, add = True)
                 
+        # The actors of the asynchronous mode fill shared memories, both
+        # with a segment per actor
+        n_actors = self.c_ag.n_actors if self.config.ag.asynchronous else 0
         self.mc_memory = self.create_memory(config = self.mc_ag,
-                                         size   = self.environment.state_size)
-        self.c_memory = self.create_memory(config = self.c_ag,
-                                         size   = self.environment.state_size + \
-                                                          self.goal_size)
+                                         size   = self.environment.state_size,
+                                         prefix = 'mc',
+                                         n_actors = n_actors)
+        # Goals are stored as integers next to the observations and turned
+        # into one-hot vectors (rows of goal_one_hots) when sampling
+        self.c_memory = self.create_memory(config      = self.c_ag,
+                                           size        = self.environment.state_size,
+                                           prefix      = 'c',
+                                           store_goals = True,
+                                           n_actors    = n_actors)
+        self.goal_one_hots = np.eye(self.goal_size, dtype = np.float32)
        
         self.m = Metrics(self.config, self.logs_dir, self.goals)
     
@@ -47,32 +63,41 @@ class HDQNAgent(base.Agent):
         return self.goals[n]
         
     def define_goals(self):
-        
-        if self.environment.env_name in CT.MDP_envs:
-            self.goal_size = self.environment.state_size
-            goals = {}
-            for n in range(self.goal_size):
-                goal_name = "g" + str(n)
-                goal = MDPGoal(n, goal_name, self.c_ag)            
-                goal.setup_one_hot(self.goal_size)
-                goals[goal.n] = goal
-        elif self.environment.env_name in CT.SF_envs:
-            #Space Fortress
-            goal_names = \
-                CT.goal_groups[self.environment.env_name][self.config.ag.goal_group]
-            goals = generate_SF_goals(
-                    environment = self.environment,
-                    goal_names  = goal_names,
-                    config      = self.c_ag)
-            self.goal_size = len(goals)
-            
-        else:
-            raise ValueError("No prior goals for " + self.environment.env_name)
+        goals = create_goals(self.environment, self.config)
+        self.goal_size = len(goals)
         self.goal_probs = np.array([1 / len(goals) for _ in goals])
         return goals
     
-    def set_next_goal(self, obs):
-        
+    @property
+    def current_goal(self):
+        """
+        Goal pursued in the first environment (the displayed one)
+        """
+        return self.current_goals[0]
+    
+    def copy_goals(self, environment):
+        """
+        Goals for another environment. The copies share the attempts (and so
+        the epsilon) with self.goals but have their own counters
+        """
+        goals = {}
+        for n, goal in self.goals.items():
+            goal = copy.copy(goal)
+            if hasattr(goal, 'environment'):
+                # SF goals
+                goal.environment = environment.gym
+            goals[n] = goal
+        return goals
+    
+    def set_next_goals(self, obs, env_idxs):
+        """
+        The meta-controller chooses the next goal of some environments, with
+        one forward pass for all of them
+        
+        params:
+            obs: float array, one observation per environment
+            env_idxs: list of ints, environments that need a new goal
+        """
         if self.is_ready_to_learn(prefix = 'mc'):
             ep = self.mc_epsilon.steps_value(self.c_step)
 
@@ -81,62 +106,80 @@ class HDQNAgent(base.Agent):
             ep = 1
         
         self.m.update_epsilon(value = ep)
-        if random.random() < ep and not self.is_playing():
-            
-            n_goal = random.randrange(self.goal_size)
-            mc_avg_q = -100
-        else:
-            feed_dict = {self.mc_s_t: [[obs]]}
-            #n_goal = self.mc_q_action.eval({self.mc_s_t: [[obs]]})[0]
-            n_goal, mc_avg_q = self.sess.run([self.mc_q_action, self.mc_avg_q,],
-                                             feed_dict)
-            mc_avg_q, n_goal =  mc_avg_q[0], n_goal[0]
-        self.mc_old_obs = obs
-        self.m.mc_goals.append(n_goal)
+        n = len(env_idxs)
+        is_random, is_greedy, n_goals = self.epsilon_greedy_draws(
+                                            'mc', ep, n, self.goal_size)
+        mc_avg_qs = self.get_acting_buffer('mc', 'avg_qs', n, np.float64)
+        mc_avg_qs[:] = -100.
+        if not is_random.all():
+            mc_obs = self._mc_obs_buffer[:n]
+            np.take(obs, env_idxs, axis = 0, out = mc_obs)
+            network = self.get_numpy_network(prefix = 'mc', step = self.c_step)
+            if network is not None:
+                q_goals, q_avgs = network.predict(mc_obs)
+            else:
+                feed_dict = {self.mc_s_t: mc_obs[:, np.newaxis]}
+                q_goals, q_avgs = self.sess.run([self.mc_q_action,
+                                                 self.mc_avg_q], feed_dict)
+            np.copyto(n_goals, q_goals, where = is_greedy)
+            np.copyto(mc_avg_qs, q_avgs, where = is_greedy)
         self.c_learnt = self.is_knowledge_of_goals_enough()
-        goal = self.get_goal(n_goal)
-        goal.set_counter += 1
-        self.current_goal = goal
-        self.current_goal.achieved_inside_frameskip = False
-        self.environment.gym.goal_has_changed = True
-        return mc_avg_q
+        for i, n_goal, mc_avg_q in zip(env_idxs, n_goals, mc_avg_qs):
+            self.mc_old_obs[i] = obs[i]
+            if i == 0:
+                self.m.mc_goals.append(n_goal)
+            goal = self.env_goals[i][n_goal]
+            goal.set_counter += 1
+            goal.achieved_inside_frameskip = False
+            self.current_goals[i] = goal
+            self._c_gs_buffer[i, :self.goal_size] = goal.one_hot
+            self.mc_avg_qs[i] = mc_avg_q
+            self.environments[i].gym.goal_has_changed = True
        
             
         
-    def predict_next_action(self, obs):
-        
-        
-        
-        #s_t should have goals and screens concatenated
-        ep = self.current_goal.epsilon
-
-        if random.random() < ep and not self.is_playing():
-            action = random.randrange(self.environment.action_size)
-            
-        else:
-            #screens = self.c_history.get()
-            
-            action = self.c_q_action.eval(
-                            {self.c_s_t: [[obs]],
-                             self.c_g_t: [self.current_goal.one_hot]})[0]
+    def predict_next_actions(self, obs):
+        """
+        Epsilon-greedy actions of the controller for all the environments
+        (each one with the epsilon of its goal), with one forward pass
+        
+        params:
+            obs: float array, one observation per environment
+        """
+        n = len(obs)
+        eps = self.get_acting_buffer('c', 'eps', n, np.float64)
+        for i, goal in enumerate(self.current_goals):
+            eps[i] = goal.epsilon
+        is_random, is_greedy, actions = self.epsilon_greedy_draws(
+                            'c', eps, n, self.environment.action_size)
+        if not is_random.all():
+            # The controller input is the goal followed by the state
+            self._c_gs_buffer[:, self.goal_size:] = obs
+            network = self.get_numpy_network(prefix = 'c', step = self.c_step)
+            if network is not None:
+                q_actions, _ = network.predict(self._c_gs_buffer)
+            else:
+                g_t = self._c_gs_buffer[:, :self.goal_size]
+                q_actions = self.c_q_action.eval({self.c_s_t: obs[:, np.newaxis],
+                                                  self.c_g_t: g_t})
+            np.copyto(actions, q_actions, where = is_greedy)
     
     
-#        action = int(self.aux(self.c_history.get()[-1]) < self.current_goal.n)
-#        print('**',self.aux(self.c_history.get()[-1]), self.current_goal.n, action)
-        self.m.c_actions.append(action)
-        return action
-    def mc_observe(self, goal_n, ext_reward, new_obs, terminal):
+        self.m.c_actions.append(actions[0])
+        return actions
+    def mc_observe(self, env_idx, goal_n, ext_reward, new_obs, terminal):
         if self.is_playing():
             return            
-        self.mc_memory.add(self.mc_old_obs, goal_n, ext_reward, new_obs, terminal)
+        self.mc_memory.add(self.mc_old_obs[env_idx], goal_n, ext_reward,
+                           new_obs, terminal, segment = env_idx)
         
 
-    def c_observe(self, old_obs, action, int_reward, new_obs, terminal):
+    def c_observe(self, old_obs, action, int_reward, new_obs, terminal, goal_n,
+                  env_idx = 0):
         if self.is_playing():
             return
-        old_state = np.hstack([self.current_goal.one_hot, old_obs])
-        next_state = np.hstack([self.current_goal.one_hot, new_obs])
-        self.c_memory.add(old_state, action, int_reward, next_state, terminal)
+        self.c_memory.add(old_obs, action, int_reward, new_obs, terminal,
+                          goal = goal_n, segment = env_idx)
         #Update C
         self.learn_if_ready(prefix = 'c')
         #Update MC   
@@ -144,62 +187,52 @@ class HDQNAgent(base.Agent):
         
     def mc_q_learning_mini_batch(self):      
         #Sample batch from memory
-        (s_t, goal, ext_reward, s_t_plus_1, terminal), idx_list, p_list, \
-                                        sum_p, count = self.mc_memory.sample()
+        (s_t, goal, ext_reward, s_t_plus_1, terminal, discount), idx_list, \
+                                p_list, sum_p, count = self.mc_memory.sample()
 
-        target_q_t = self.generate_target_q_t(prefix       = 'mc',
-                                              reward       = ext_reward,
-                                              s_t_plus_1   = s_t_plus_1,
-                                              terminal     = terminal)
-        feed_dict = {
-            self.mc_target_q_t: target_q_t,
-            self.mc_action: goal,
-            self.mc_s_t: s_t,
-            self.mc_learning_rate_step: self.mc_step,
-        }
+        feed_dict = self.learner_feed_dict(prefix     = 'mc',
+                                           s_t        = s_t,
+                                           action     = goal,
+                                           reward     = ext_reward,
+                                           s_t_plus_1 = s_t_plus_1,
+                                           terminal   = terminal,
+                                           discount   = discount)
         
         if self.mc_ag.pmemory:
             # Prioritized replay memory
             beta = (1 - self.mc_epsilon.steps_value(self.c_step)) + self.mc_epsilon.end        
             self.m.mc_beta = beta
-            loss_weight = (np.array(p_list)*count/sum_p)**(-beta)
-            feed_dict[self.mc_loss_weight] = loss_weight  
+            feed_dict[self.mc_loss_weight] = self.loss_weights('mc', p_list,
+                                                               sum_p, count,
+                                                               beta)  
             
 
-        _, q_t, mc_td_error, loss = self.sess.run([self.mc_optim,
-                                                             self.mc_q,
-                                                             self.mc_td_error,
-                                                             self.mc_loss],
-                                                             #self.mc_q_summary],
-                                                            feed_dict)
+        fetches = [self.mc_optim, self.mc_q_train, self.mc_td_error,
+                   self.mc_loss]
+        if self.mc_ag.pmemory:
+            fetches.append(self.mc_priority)
+        _, q_t, mc_td_error, loss, *priority = self.sess.run(fetches,
+                                                             feed_dict)
+        if self.mc_ag.pmemory:
+            self.mc_memory.update_priorities(idx_list, priority[0])
 
         self.m.mc_add_update(loss, q_t.mean(), mc_td_error.mean())
         
     def c_q_learning_mini_batch(self):
         #Sample batch from memory        
-        (s_t, action, int_reward, s_t_plus_1, terminal), idx_list, p_list, \
-                                        sum_p, count = self.c_memory.sample()
-        
-        #TODO: optimize how goals are stored in memory (and how are they retrieved)
-        g_t = np.vstack([g[0] for g in s_t[:, :, :self.goal_size]]) 
-        s_t = s_t[:, :, self.goal_size:]
-        
-        
-        g_t_plus_1 = np.vstack([g[0] for g in s_t_plus_1[:, :, :self.goal_size]])
-        s_t_plus_1 = s_t_plus_1[:, :, self.goal_size:]
-        
-        target_q_t = self.generate_target_q_t(prefix       = 'c',
-                                              reward       = int_reward,
-                                              s_t_plus_1   = s_t_plus_1,
-                                              terminal     = terminal,
-                                              g_t_plus_1   = g_t_plus_1)
-        feed_dict = {
-            self.c_target_q_t: target_q_t,
-            self.c_action: action,
-            self.c_s_t: s_t,
-            self.c_g_t: g_t,
-            self.c_learning_rate_step: self.c_step,
-        }
+        (s_t, action, int_reward, s_t_plus_1, terminal, discount, goal), \
+                      idx_list, p_list, sum_p, count = self.c_memory.sample()
+        g_t = self.get_feed_buffer('c', 'g_t', (len(goal), self.goal_size))
+        np.take(self.goal_one_hots, goal, axis = 0, out = g_t)
+        
+        feed_dict = self.learner_feed_dict(prefix     = 'c',
+                                           s_t        = s_t,
+                                           action     = action,
+                                           reward     = int_reward,
+                                           s_t_plus_1 = s_t_plus_1,
+                                           terminal   = terminal,
+                                           discount   = discount,
+                                           g_t        = g_t)
         if self.c_ag.pmemory:
             if self.is_ready_to_learn(prefix = 'mc'):
                 beta = (1 - self.mc_epsilon.steps_value(self.c_step)) + \
@@ -207,17 +240,16 @@ class HDQNAgent(base.Agent):
             else:
                 beta = self.mc_epsilon.end
             self.m.c_beta = beta
-            loss_weight = (np.array(p_list)*count/sum_p)**(-beta)
-            feed_dict[self.c_loss_weight] = loss_weight
-            pass
+            feed_dict[self.c_loss_weight] = self.loss_weights('c', p_list,
+                                                              sum_p, count,
+                                                              beta)
             
-        _, q_t, c_td_error, loss, loss_aux = self.sess.run([self.c_optim,
-                                                               self.c_q,
-                                                               self.c_td_error,
-                                                               self.c_loss,
-                                                               self.c_loss_aux],
-                                                               #self.c_q_summary],
-                                                            feed_dict)
+        fetches = [self.c_optim, self.c_q_train, self.c_td_error, self.c_loss]
+        if self.c_ag.pmemory:
+            fetches.append(self.c_priority)
+        _, q_t, c_td_error, loss, *priority = self.sess.run(fetches, feed_dict)
+        if self.c_ag.pmemory:
+            self.c_memory.update_priorities(idx_list, priority[0])
         self.m.c_add_update(loss, q_t.mean(), c_td_error.mean())
 
 
@@ -225,6 +257,9 @@ class HDQNAgent(base.Agent):
         self.train()
     
     def train(self):
+        if self.config.ag.asynchronous and not self.is_playing():
+            self.train_asynchronous()
+            return
         self.start_train_timer()
         #Auxiliary flags (for monitoring)
         self.mc_flag_start_training, self.c_flag_start_training = False, False
@@ -240,86 +275,286 @@ class HDQNAgent(base.Agent):
         #Set up epsilon ofr MC (e-greedy, linear decay)
         self.mc_epsilon = Epsilon()
         self.mc_epsilon.setup(self.mc_ag, self.total_steps)
-        old_obs = self.new_episode()        
+        # Observations of the environments (acting is batched over them).
+        # Each environment has its own copy of the goals
+        self.environments = self.create_environments(self.config.ag.n_envs)
+        n_envs = len(self.environments)
+        self.env_goals = [self.goals] + [self.copy_goals(env) for env \
+                                                   in self.environments[1:]]
+        old_obs = np.array([self.new_episode()] + [env.new_game()[0] for env \
+                                                   in self.environments[1:]])
         self.m.start_timer()
         
-        # Initial goal
+        # Initial goals
         self.mc_step = self.mc_start_step
         self.c_step = self.c_start_step
-        mc_avg_q = self.set_next_goal(old_obs)
-        
+        self.current_goals = [None] * n_envs
+        # Inputs of the controller (goal and observation of each environment),
+        # the goals are written when they are set, and of the meta-controller
+        self._c_gs_buffer = np.zeros((n_envs,
+                                      self.goal_size + self.environment.state_size),
+                                     dtype = np.float32)
+        self._mc_obs_buffer = np.zeros(old_obs.shape, dtype = old_obs.dtype)
+        self.mc_old_obs = old_obs.copy()
+        self.mc_avg_qs = np.zeros(n_envs)
+        # External reward of the current MC transition of each environment
+        mc_rewards = np.zeros(n_envs)
+        self.set_next_goals(old_obs, list(range(n_envs)))
+        # Environments whose goal has finished
+        pending_goals = []
         
         iterator = self.get_iterator(start_step  = self.c_start_step,
                                      total_steps = self.total_steps)
             
+        # The environments are stepped in lockstep, each step of the loop
+        # being the step of one of them. Their next goals and actions are
+        # predicted together every n_envs steps. Metrics and display follow
+        # the first environment
         for self.c_step in iterator:
+            i = (self.c_step - self.c_start_step) % n_envs
+            if i == 0:
+                # Meta-controller sets goals
+                if pending_goals:
+                    self.set_next_goals(old_obs, pending_goals)
+                    pending_goals = []
+                actions = self.predict_next_actions(old_obs)
 
             # Controller acts
-            action = self.predict_next_action(old_obs)
-            info = {'goal_name'       : self.current_goal.name,
+            action = actions[i]
+            goal = self.current_goals[i]
+            info = {'goal_name'       : goal.name,
                     'is_SF'           : self.m.is_SF,
-                    'display_episode' : self.display_episode,
-                    'watch'           : self.gl.watch,
-                    'avg_q'           : mc_avg_q,
-                    'goal'            : self.current_goal}
+                    'display_episode' : self.display_episode and i == 0,
+                    'watch'           : self.gl.watch and i == 0,
+                    'avg_q'           : self.mc_avg_qs[i],
+                    'goal'            : goal}
             
-            new_obs, ext_reward, terminal, info = self.environment.act(
+            new_obs, ext_reward, terminal, info = self.environments[i].act(
                                         action = action,
                                         info   = info)
-            self.current_goal.steps_counter += 1
-            self.process_info(info)            
-            self.m.add_act(action, self.environment.gym.one_hot_inverse(new_obs))
+            goal.steps_counter += 1
+            if i == 0:
+                self.process_info(info)            
+                self.m.add_act(action, self.environment.gym.one_hot_inverse(new_obs))
             
 
-            goal_achieved = self.current_goal.is_achieved(new_obs, action, info)
+            goal_achieved = goal.is_achieved(new_obs, action, info)
             int_reward = 1. if goal_achieved else 0.
             int_reward -= self.c_ag.intrinsic_time_penalty
-            self.c_observe(old_obs, action, int_reward, new_obs,
-                                       terminal or goal_achieved)
+            self.c_observe(old_obs[i], action, int_reward, new_obs,
+                           terminal or goal_achieved, goal.n, i)
+            mc_rewards[i] += ext_reward
             
-            if self.display_episode:
-                self.console_print(old_obs, action, ext_reward, int_reward)  
-            self.m.increment_rewards(int_reward, ext_reward)
+            if i == 0:
+                if self.display_episode:
+                    self.console_print(old_obs[i], action, ext_reward, int_reward)  
+                self.m.increment_rewards(int_reward, ext_reward)
 
             if terminal or goal_achieved:
                 
-                self.current_goal.finished(self.m, goal_achieved)
+                goal.finished(self.m, goal_achieved)
                 # Meta-controller learns                
-                self.mc_observe(goal_n     = self.current_goal.n,
-                                ext_reward = self.m.mc_step_reward,
+                self.mc_observe(env_idx    = i,
+                                goal_n     = goal.n,
+                                ext_reward = mc_rewards[i],
                                 new_obs    = new_obs,
                                 terminal   = terminal)
-                reward = self.m.mc_step_reward
-                self.m.mc_step_reward = 0    
+                reward = mc_rewards[i]
+                mc_rewards[i] = 0
+                if i == 0:
+                    self.m.mc_step_reward = 0    
                 
-                if terminal:
+                if terminal and i == 0:
                     if self.display_episode:
                         self.console_print_terminal(reward, new_obs)
                     self.m.close_episode()
-                    old_obs = self.new_episode()
-
-                else:
-                    old_obs = new_obs.copy()
+                    old_obs[i] = self.new_episode()
+                elif terminal:
+                    old_obs[i] = self.environments[i].new_game()[0]
                 """
                 self.mc_step is the MC equivalent for self.c_step (global counter)
                 and self.m_mc_steps is the MC equivalent for self.c.test_step,
                 which is constant in the case of C but not in the case of MC
                 """
                 self.mc_step += 1   
-                self.m.mc_steps += 1
+                if i == 0:
+                    self.m.mc_steps += 1
                 
-                # Meta-controller sets goal
-                mc_avg_q = self.set_next_goal(old_obs)
-                self.m.mc_goals.append(self.current_goal.n)
+                # The next goal is set before the next actions are predicted
+                pending_goals.append(i)
             if not terminal:
-                old_obs = new_obs.copy()
+                old_obs[i] = new_obs
 
             if not self.is_testing_time(prefix = 'c'):
                 continue
             
-            self.m.compute_test('c')
-            self.m.compute_test('mc')
-            self.m.compute_goal_results(self.goals)
+            self.test()
+        self.stop_train_timer()
+            
+    def train_asynchronous(self):
+        """
+        Ape-X like training. c_ag.n_actors processes (actors.run_hdqn_actor)
+        act on their own environments and fill the shared replay memories,
+        while this process only updates the networks and broadcasts their
+        weights (and the epsilon of MC) every actor_update_step steps.
+        The steps are the steps of all the actors together
+        """
+        if multiprocessing.current_process().daemon:
+            raise ValueError("asynchronous is not compatible with parallel")
+        self.start_train_timer()
+        self.mc_flag_start_training, self.c_flag_start_training = False, False
+        self.c_learnt = False
+        self.mc_start_step = self.mc_step_op.eval()
+        self.c_start_step = self.c_step_op.eval()
+        self.total_steps = self.config.ag.max_step + self.c_start_step
+        self.mc_epsilon = Epsilon()
+        self.mc_epsilon.setup(self.mc_ag, self.total_steps)
+        self.mc_step = self.mc_start_step
+        self.c_step = self.c_start_step
+        self.m.start_timer()
+        
+        prefixes = ['c', 'mc']
+        n_actors = self.c_ag.n_actors
+        shapes = {prefix: {name: var.get_shape().as_list() for name, var \
+                           in self.get(prefix, 'w').items()} \
+                  for prefix in prefixes}
+        broadcast = actors.WeightBroadcast(shapes, n_actors)
+        memories = {}
+        for prefix in prefixes:
+            memory = self.get(prefix, 'memory')
+            if isinstance(memory, PrefetchingMemory):
+                memory = memory.memory
+            memories[prefix] = memory
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        processes = []
+        for actor_id in range(n_actors):
+            seed = self.config.gl.random_seed + actor_id + 1
+            process = context.Process(target = actors.run_hdqn_actor,
+                                      args   = (actor_id, self.config,
+                                                memories['c'],
+                                                memories['mc'], broadcast,
+                                                results, seed))
+            process.start()
+            processes.append(process)
+            
+        # Boundaries (in steps) of the last target update, weights broadcast
+        # and test, as the steps move forward several at a time
+        last = {'c' : self.c_step, 'mc' : self.mc_step}
+        last_broadcast, last_test = self.c_step, self.c_step
+        updates = {'c' : 0, 'mc' : 0}
+        try:
+            self.broadcast_weights(broadcast)
+            while self.c_step < self.total_steps:
+                c_steps, mc_steps = broadcast.steps.sum(axis = 0)
+                self.c_step = self.c_start_step + int(c_steps)
+                self.m.mc_steps += self.mc_start_step + int(mc_steps) - \
+                                                                self.mc_step
+                self.mc_step = self.mc_start_step + int(mc_steps)
+                self.process_actor_results(results)
+                
+                learnt = False
+                for prefix in prefixes:
+                    if not self.is_ready_to_learn(prefix = prefix):
+                        continue
+                    cnf = self.get(prefix, 'ag')
+                    step = self.get(prefix, 'step')
+                    start_step = self.get(prefix, 'start_step')
+                    # Don't go beyond replay_ratio updates per step (one
+                    # every train_frequency steps by default, as when acting)
+                    ratio = cnf.replay_ratio if cnf.replay_ratio > 0 else \
+                                                    1. / cnf.train_frequency
+                    if updates[prefix] >= ratio * (step - start_step):
+                        continue
+                    self.get(prefix, 'q_learning_mini_batch')()
+                    updates[prefix] += 1
+                    learnt = True
+                    if cnf.target_tau > 0:
+                        self.sess.run(self.get(prefix, 'target_w_soft_update_op'))
+                    elif step // cnf.target_q_update_step > \
+                                    last[prefix] // cnf.target_q_update_step:
+                        self.update_target_q_network(prefix)
+                    last[prefix] = step
+                if not learnt:
+                    # Wait for the actors
+                    time.sleep(.01)
+                    
+                if self.c_step // self.config.ag.actor_update_step > \
+                            last_broadcast // self.config.ag.actor_update_step:
+                    self.broadcast_weights(broadcast)
+                    last_broadcast = self.c_step
+                if self.c_step // self.c_ag.test_step > \
+                                        last_test // self.c_ag.test_step:
+                    # Steps of all the actors since the last test
+                    test_steps = self.c_step - last_test
+                    last_test = self.c_step
+                    if self.is_ready_to_learn(prefix = 'c'):
+                        self.test(steps = test_steps)
+        finally:
+            broadcast.stop()
+            # An actor blocked on a full results queue would never exit
+            while any(process.is_alive() for process in processes):
+                try:
+                    results.get(timeout = .1)
+                except queue.Empty:
+                    pass
+            for process in processes:
+                process.join()
+            broadcast.close()
+        self.stop_train_timer()
+        
+    def broadcast_weights(self, broadcast):
+        """
+        Publishes the weights of C and MC and the epsilon of MC for the actors
+        """
+        if self.is_ready_to_learn(prefix = 'mc'):
+            ep = self.mc_epsilon.steps_value(self.c_step)
+        else:
+            ep = 1
+        self.m.update_epsilon(value = ep)
+        weights = self.sess.run({'c' : self.c_w, 'mc' : self.mc_w})
+        broadcast.publish(weights, [ep])
+        
+    def process_actor_results(self, results):
+        """
+        Updates the goals and the metrics with the results sent by the actors
+        
+        params:
+            results: multiprocessing.Queue with ('goal', goal_n, achieved,
+                steps) and ('episode', ext_reward, int_reward) tuples
+        """
+        while True:
+            try:
+                result = results.get_nowait()
+            except queue.Empty:
+                break
+            if result[0] == 'goal':
+                _, goal_n, achieved, steps_counter = result
+                goal = self.goals[goal_n]
+                goal.set_counter += 1
+                goal.steps_counter = steps_counter
+                goal.finished(self.m, achieved)
+                goal.update_success_rate()
+            else:
+                _, ext_reward, int_reward = result
+                self.m.increment_rewards(int_reward, ext_reward)
+                self.m.mc_step_reward = 0
+                self.m.close_episode()
+        self.c_learnt = self.is_knowledge_of_goals_enough()
+        
+        
+    def test(self, steps = None):
+        """
+        Computes the metrics of the last test_step steps, writes them to
+        tensorboard and saves the model if it has improved
+        
+        params:
+            steps: int, steps since the last test if they are not test_step
+                (asynchronous mode)
+        """
+        self.m.compute_test('c', steps = steps)
+        self.m.compute_test('mc')
+        self.m.compute_goal_results(self.goals)
 #            print("\nName\tEpsilon\tAttempts\tSuccesses\tRate\tR2")
 #            for i, goal in self.goals.items():
 #                print("%s\t%.2f\t%d\t%d\t%.2f\t%.2f" % (goal.name.ljust(20),
@@ -328,34 +563,31 @@ class HDQNAgent(base.Agent):
 #                                            goal.achieved_counter,
 #                                            goal.success_rate,
 #                                            goal.achieved_counter / goal.set_counter))
-            #self.c_learnt = goal_success_rate > self.c_ag.learnt_threshold
+        #self.c_learnt = goal_success_rate > self.c_ag.learnt_threshold
 
-            self.m.compute_state_visits()
+        self.m.compute_state_visits()
+        
+        if self.m.has_improved():
+            self.c_step_assign_op.eval(
+                    {self.c_step_input: self.c_step + 1})
+            self.mc_step_assign_op.eval(
+                    {self.mc_step_input: self.mc_step + 1})
+            self.delete_last_checkpoints()
+            self.save_model(self.c_step + 1)
+            #self.save_model(self.mc_step + 1)
+            self.m.update_best_score()
             
-            if self.m.has_improved():
-                self.c_step_assign_op.eval(
-                        {self.c_step_input: self.c_step + 1})
-                self.mc_step_assign_op.eval(
-                        {self.mc_step_input: self.mc_step + 1})
-                self.delete_last_checkpoints()
-                self.save_model(self.c_step + 1)
-                #self.save_model(self.mc_step + 1)
-                self.m.update_best_score()
-                
 
-            self.send_some_metrics(prefix = 'mc')
-            self.send_some_metrics(prefix = 'c')
-            summary = self.m.get_summary()
-            self.m.filter_summary(summary)
-            #self.m.rename_summary(summary)
-            self.inject_summary(summary, self.c_step)
-            self.write_output()
-            # Restart metrics
-            self.m.restart()
-        self.stop_train_timer()
-            
-        
-        
+        self.send_some_metrics(prefix = 'mc')
+        self.send_some_metrics(prefix = 'c')
+        summary = self.m.get_summary()
+        self.m.filter_summary(summary)
+        #self.m.rename_summary(summary)
+        self.inject_summary(summary, self.c_step)
+        self.write_output()
+        # Restart metrics
+        self.m.restart()
+
     def build_meta_controller(self):
         self.mc_w = {}
         self.mc_target_w = {}
@@ -488,6 +720,8 @@ class HDQNAgent(base.Agent):
         self.load_model()
         self.update_target_q_network(prefix = 'mc')
         self.update_target_q_network(prefix = 'c')
+        self.create_numpy_network(prefix = 'mc')
+        self.create_numpy_network(prefix = 'c')
         
     def is_knowledge_of_goals_enough(self):
         if self.c_learnt:
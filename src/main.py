@@ -1,6 +1,7 @@
 import os
 import random
 import argparse
+import numpy as np
 
 import tensorflow as tf
 
@@ -32,6 +33,12 @@ gl_args.add_argument("--log_level", choices=["DEBUG", "INFO", "WARNING", "ERROR"
 gl_args.add_argument("--display_prob", default = None, type = float)
 gl_args.add_argument("--watch", default = None, type = utils.str2bool)
 gl_args.add_argument("--parallel", default = 0, type = int)
+gl_args.add_argument("--xla", default = None, type = utils.str2bool,
+                     help = "XLA JIT compilation of the graph (on CPU, also " \
+                            "set TF_XLA_FLAGS=--tf_xla_cpu_global_jit)")
+gl_args.add_argument("--intra_op_threads", default = None, type = int)
+gl_args.add_argument("--inter_op_threads", default = None, type = int)
+gl_args.add_argument("--pin_cpus", default = None, type = utils.str2bool)
 gl_args.add_argument("--date", default = None, type = str)
 gl_args.add_argument("--experiment_name", default = None, type = str)
 
@@ -69,7 +76,34 @@ ag_args.add_argument("--c_pmemory", default = None, type = utils.str2bool)
 ag_args.add_argument("--mc_double_q", default = None, type = utils.str2bool)
 ag_args.add_argument("--mc_dueling", default = None, type = utils.str2bool)
 ag_args.add_argument("--mc_pmemory", default = None, type = utils.str2bool)
+ag_args.add_argument("--target_tau", default = None, type = float)
+ag_args.add_argument("--c_target_tau", default = None, type = float)
+ag_args.add_argument("--mc_target_tau", default = None, type = float)
+ag_args.add_argument("--batch_size", default = None, type = int)
+ag_args.add_argument("--c_batch_size", default = None, type = int)
+ag_args.add_argument("--mc_batch_size", default = None, type = int)
+ag_args.add_argument("--replay_ratio", default = None, type = float)
+ag_args.add_argument("--c_replay_ratio", default = None, type = float)
+ag_args.add_argument("--mc_replay_ratio", default = None, type = float)
 ag_args.add_argument("--memory_size", default = None, type = int)
+ag_args.add_argument("--n_step", default = None, type = int)
+ag_args.add_argument("--c_n_step", default = None, type = int)
+ag_args.add_argument("--mc_n_step", default = None, type = int)
+ag_args.add_argument("--memory_on_disk", default = None, type = utils.str2bool)
+ag_args.add_argument("--c_memory_on_disk", default = None, type = utils.str2bool)
+ag_args.add_argument("--mc_memory_on_disk", default = None, type = utils.str2bool)
+precisions = ['float32', 'float16', 'uint16', 'uint8']
+ag_args.add_argument("--memory_precision", choices = precisions, default = None, type = str)
+ag_args.add_argument("--c_memory_precision", choices = precisions, default = None, type = str)
+ag_args.add_argument("--mc_memory_precision", choices = precisions, default = None, type = str)
+ag_args.add_argument("--prefetch", default = None, type = int)
+ag_args.add_argument("--c_prefetch", default = None, type = int)
+ag_args.add_argument("--mc_prefetch", default = None, type = int)
+ag_args.add_argument("--n_actors", default = None, type = int)
+ag_args.add_argument("--n_envs", default = None, type = int)
+ag_args.add_argument("--numpy_inference_step", default = None, type = int)
+ag_args.add_argument("--asynchronous", default = None, type = utils.str2bool)
+ag_args.add_argument("--actor_update_step", default = None, type = int)
 ag_args.add_argument("--goal_group", default = None, type = int)
 ag_args.add_argument("--ep_start", default = None, type = float)
 ag_args.add_argument("--c_intrinsic_time_penalty", default = None, type = float)
@@ -136,6 +170,7 @@ def execute_experiment(args):
     
     tf.set_random_seed(gl_st.random_seed)
     random.seed(gl_st.random_seed)
+    np.random.seed(gl_st.random_seed)
     
     if gl_st.gpu_fraction == '':
         raise ValueError("--gpu_fraction should be defined")
@@ -146,7 +181,28 @@ def execute_experiment(args):
     frac = utils.calc_gpu_fraction(gl_st.gpu_fraction)
     gpu_options = tf.GPUOptions(
             per_process_gpu_memory_fraction=frac)
-    with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as sess:        
+    intra_threads = gl_st.intra_op_threads
+    inter_threads = gl_st.inter_op_threads
+    if gl_st.parallel > 0:
+        # Each run uses its share of the cores instead of TF default thread
+        # pools of the size of the whole machine
+        cores = utils.get_worker_cores(gl_st.parallel, utils.worker_index)
+        if gl_st.pin_cpus:
+            os.sched_setaffinity(0, cores)
+        intra_threads = intra_threads or len(cores)
+        inter_threads = inter_threads or 1
+    session_config = tf.ConfigProto(
+            gpu_options=gpu_options,
+            intra_op_parallelism_threads=intra_threads,
+            inter_op_parallelism_threads=inter_threads)
+    if gl_st.xla:
+        # The ops of the graph (forward passes and updates) are clustered and
+        # compiled with XLA JIT. On CPU the auto-clustering also needs
+        # TF_XLA_FLAGS=--tf_xla_cpu_global_jit, which TF only reads at import
+        # so it has to be set before running this script
+        session_config.graph_options.optimizer_options.global_jit_level = \
+                                                    tf.OptimizerOptions.ON_1
+    with tf.Session(config=session_config) as sess:        
 
         
         if ag_st.agent_type == 'dqn':
@@ -168,6 +224,9 @@ def execute_experiment(args):
             agent.play()
         elif ag_st.mode == 'graph':
             pass
+        elif ag_st.mode == 'benchmark':
+            # e.g. to compare the updates per second with and without --xla
+            agent.benchmark()
         else:
             raise ValueError("Wrong mode " + str(ag_st.mode))
         
@@ -198,9 +257,14 @@ if __name__ == "__main__":
             execute_experiment(args_)
     else:
         # Execute experiments in parallel
-        from multiprocessing import Pool    
+        from multiprocessing import Pool, Queue
         n_processes = args['parallel']
-        with Pool(n_processes) as pool:
+        # Each worker takes its index, to use its own share of the cores
+        worker_indexes = Queue()
+        for i in range(n_processes):
+            worker_indexes.put(i)
+        with Pool(n_processes, initializer = utils.set_worker_index,
+                  initargs = (worker_indexes,)) as pool:
             pool.starmap(execute_experiment, zip(args_list))
     print("Done :D")
         
@@ -37,7 +37,8 @@ class Metrics:
     def _define_metrics(self, goals):
         self.scalar_global_tags = ['elapsed_time', 'games',
                                  'total_episodes', 'debug_states_rfreq_sum',
-                                 'debug_no_ep_error', 'progress']
+                                 'debug_no_ep_error', 'progress',
+                                 'steps_per_second']
         if self.config.env.env_name == 'SF-v0':
             self.special_SF_tags = ['steps_to_destroy', 'steps_to_win', 'secs_to_win']
             self.scalar_global_tags += ['fortress_hits', 'wins', 'mine_hits',
@@ -63,7 +64,8 @@ class Metrics:
                      'max_epis_pmemory_reward', 'min_ep_reward', \
                      'avg_ep_reward', 'learning_rate', 'total_reward', \
                      'ep_reward', 'total_loss', 'total_q', 'update_count',
-                     'memory_size', 'td_error', 'steps_per_episode']
+                     'memory_size', 'td_error', 'steps_per_episode',
+                     'updates_per_second']
         if self.is_hdqn:
             # hDQN
             if self.mc_params.pmemory:
@@ -349,7 +351,8 @@ class Metrics:
           
         return summary
    
-    def compute_test(self, prefix, update_count = None, mc_steps = None):
+    def compute_test(self, prefix, update_count = None, mc_steps = None,
+                     steps = None):
         assert prefix in ['c', 'mc', '']
         prefix = prefix + '_' if prefix != '' else prefix
         update_count = getattr(self, prefix + 'update_count')
@@ -360,11 +363,19 @@ class Metrics:
         config = getattr(self, prefix + 'params')
         if prefix == 'mc_':
             test_step = self.mc_steps    
+        elif steps is not None:
+            test_step = steps
         else:
             test_step = config.test_step
         total_reward = getattr(self, prefix + 'total_reward')
         if test_step > 0:
             setattr(self, prefix + 'avg_reward', total_reward / test_step)
+        # Throughput since the last restart, to balance acting and learning
+        # (see replay_ratio)
+        seconds = time.time() - self.t0
+        setattr(self, prefix + 'updates_per_second', update_count / seconds)
+        if prefix != 'mc_':
+            setattr(self, 'steps_per_second', test_step / seconds)
         total_loss = getattr(self, prefix + 'total_loss')
         if update_count > 0:
             setattr(self, prefix + 'avg_loss', total_loss / update_count)
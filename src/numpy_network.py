@@ -0,0 +1,62 @@
+import numpy as np
+
+
+class NumpyQNetwork:
+    """
+    NumPy version of the forward pass of the Q networks built with
+    Agent.add_dense_layers, utils.linear and Agent.add_dueling, so that
+    actions can be chosen without a TF session (e.g. in actor processes).
+
+    The network is defined by its parameters dictionary (the 'w' of a module),
+    which has the hidden layers 'l1_w', 'l1_b', ... and either the 'q_w' and
+    'q_b' output or the dueling streams ('value_hid_l1_w', ..., 'value_out_w',
+    'adv_hid_l1_w', ..., 'adv_out_w', ...).
+    """
+    def __init__(self, weights = None):
+        self.weights = None
+        if weights is not None:
+            self.set_weights(weights)
+
+    def set_weights(self, weights):
+        """
+        params:
+            weights: dictionary with the parameters of the network as arrays
+        """
+        self.weights = {name: np.asarray(value, dtype = np.float32) \
+                        for name, value in weights.items()}
+        self.dueling = 'value_out_w' in self.weights
+
+    def _dense_layers(self, x, name_aux):
+        i = 1
+        while '%sl%d_w' % (name_aux, i) in self.weights:
+            layer_name = name_aux + 'l' + str(i)
+            x = np.dot(x, self.weights[layer_name + '_w'])
+            x += self.weights[layer_name + '_b']
+            np.maximum(x, 0., out = x)
+            i += 1
+        return x
+
+    def q_values(self, x):
+        """
+        params:
+            x: float array, batch of inputs. States with history are flattened
+                (and the controller expects the goals concatenated first)
+        """
+        w = self.weights
+        x = np.reshape(x, (len(x), -1)).astype(np.float32)
+        last_layer = self._dense_layers(x, '')
+        if not self.dueling:
+            return np.dot(last_layer, w['q_w']) + w['q_b']
+        value_hid = self._dense_layers(last_layer, 'value_hid_')
+        adv_hid = self._dense_layers(last_layer, 'adv_hid_')
+        value = np.dot(value_hid, w['value_out_w']) + w['value_out_b']
+        adv = np.dot(adv_hid, w['adv_out_w']) + w['adv_out_b']
+        return value + (adv - adv.mean(axis = 1, keepdims = True))
+
+    def predict(self, x):
+        """
+        returns:
+            greedy actions and their Q values
+        """
+        q = self.q_values(x)
+        return q.argmax(axis = 1), q.max(axis = 1)
@@ -1,45 +1,296 @@
 """Code from https://github.com/tambetm/simple_dqn/blob/master/src/replay_memory.py"""
 
+import os
+import queue
 import random
+import threading
 import numpy as np
+from sum_tree import SumTree
 #import sys
 #sys.path.insert(0, '..')
 
 
+def is_memory_on_disk(memory_dir):
+    """
+    Whether memory_dir holds a replay memory that can be resumed
+    """
+    return memory_dir is not None and \
+                os.path.isfile(os.path.join(memory_dir, 'pointers.dat'))
+
+def create_column(memory_dir, name, shape, dtype, resume = False):
+    """
+    Preallocates a column of a replay memory. If memory_dir is given the
+    column is a np.memmap file in that directory, so it survives the run
+    and it can be bigger than the RAM (pages are loaded lazily).
+
+    params:
+        memory_dir: string or None, directory of the memory files
+        name: string, name of the column (and of its file)
+        shape: tuple, shape of the column
+        dtype: numpy type of the column
+        resume: bool, if True the content of an existing file is kept
+    """
+    if memory_dir is None:
+        # Zeros, the priorities of a SumTree must start at 0
+        return np.zeros(shape, dtype = dtype)
+    path = os.path.join(memory_dir, name + '.dat')
+    if resume and os.path.getsize(path) != \
+                        int(np.prod(shape)) * np.dtype(dtype).itemsize:
+        # e.g. the memory was filled with a different memory_size or n_envs
+        raise ValueError("%s does not match the memory settings" % path)
+    mode = 'r+' if resume else 'w+'
+    return np.memmap(path, dtype = dtype, mode = mode, shape = shape)
+
+def import_shared_memory():
+    """
+    multiprocessing.shared_memory (Python >= 3.8). It is only imported by
+    the asynchronous mode, so the rest of the project still runs on 3.6
+    """
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise ImportError("Shared replay memories and the asynchronous mode" \
+                          " need Python >= 3.8")
+    return shared_memory
+
+def create_shared_memory(size):
+    """
+    Creates a shared memory block of size bytes
+    """
+    return import_shared_memory().SharedMemory(create = True, size = size)
+
+def attach_shared_memory(name):
+    """
+    Attaches to an existing shared memory block. Only its creator frees it,
+    so it is not tracked by this process when possible (Python >= 3.13).
+    Before that, processes started with multiprocessing share the resource
+    tracker of their parent so the block is only tracked once anyway
+    """
+    shared_memory = import_shared_memory()
+    try:
+        return shared_memory.SharedMemory(name = name, track = False)
+    except TypeError:
+        return shared_memory.SharedMemory(name = name)
+
+# Storage types for the observations of the replay memories. The unsigned
+# integer ones keep a fixed-point version of features in [0, 1] (as all the
+# Space Fortress features) and are dequantized to float32 when sampling
+SCREEN_DTYPES = {'float32' : np.float32,
+                 'float16' : np.float16,
+                 'uint16'  : np.uint16,
+                 'uint8'   : np.uint8}
+
+def get_screen_dtype(config, default):
+    """
+    Storage type of the observations according to config.memory_precision
+    (the default type of the memory is used if it is not set)
+    """
+    precision = getattr(config, 'memory_precision', None)
+    if not precision:
+        return np.dtype(default)
+    return np.dtype(SCREEN_DTYPES[precision])
+
+def encode_screen(screen, dtype):
+    if dtype.kind == 'u':
+        screen = np.rint(np.clip(screen, 0., 1.) * np.iinfo(dtype).max)
+    return np.asarray(screen).astype(dtype)
+
+def create_screen_buffers(shape, dtype):
+    """
+    Preallocates the buffers of a batch of states. Returns the buffer where
+    the stored screens are gathered and the one with the (dequantized)
+    states, which is the same one if no dequantization is needed
+    """
+    raw = np.empty(shape, dtype = dtype)
+    if dtype.kind != 'u':
+        return raw, raw
+    return raw, np.empty(shape, dtype = np.float32)
+
+def decode_screens(raw, out):
+    if raw is not out:
+        np.multiply(raw, 1. / np.iinfo(raw.dtype).max, out = out)
+
+def setup_n_step(memory, config):
+    """
+    Sets up the n-step returns of a memory. Each sampled transition is
+    followed n_step - 1 transitions further, rewards are accumulated with
+    discount and the last state is used for bootstrapping with
+    discount^steps
+    """
+    memory.n_step = getattr(config, 'n_step', 1)
+    memory.n_step_offsets = np.arange(memory.n_step)
+    memory.discount_powers = config.discount ** np.arange(memory.n_step + 1)
+    # Bootstrapping discounts when n_step = 1
+    memory._discounts = np.full(memory.batch_size, config.discount)
+
+
 class OldReplayMemory:
-    def __init__(self, config, screen_size):
-        self.memory_size = config.memory_size
-        self.actions = np.empty(self.memory_size, dtype = np.uint8)
-        self.rewards = np.empty(self.memory_size, dtype = np.float16)
-        self.screens = np.empty((self.memory_size, screen_size), dtype = np.float16)
-        self.terminals = np.empty(self.memory_size, dtype = np.bool)
+    """
+    The screens of consecutive slots are consecutive observations, so when
+    several environments act in lockstep (n_segments > 1) each one writes
+    its own segment of slots (see add)
+    """
+    def __init__(self, config, screen_size, store_goals = False,
+                 memory_dir = None, n_segments = 1):
+        self.n_segments = n_segments
+        self.segment_size = config.memory_size // n_segments
+        self.memory_size = self.segment_size * n_segments
+        # If memory_dir is given the columns are files in that directory and
+        # the memory is restored from them if they already exist
+        self.memory_dir = memory_dir
+        self.restored = is_memory_on_disk(memory_dir)
+        column = lambda *args: create_column(memory_dir, *args,
+                                             resume = self.restored)
+        self.actions = column('actions', self.memory_size, np.uint8)
+        # Goal pursued during each transition (only for the hDQN controller)
+        self.goals = column('goals', self.memory_size, np.uint8) if store_goals else None
+        self.rewards = column('rewards', self.memory_size, np.float16)
+        screen_dtype = get_screen_dtype(config, default = np.float16)
+        self.screens = column('screens', (self.memory_size, screen_size), screen_dtype)
+        self.terminals = column('terminals', self.memory_size, np.bool)
+        # count and current of each segment
+        self._pointers = column('pointers', (n_segments, 2), np.int64)
         self.history_length = config.history_length
         self.dims = (screen_size,)
         self.batch_size = config.batch_size
-        self.count = 0
-        self.current = 0
+        self.counts = np.zeros(n_segments, dtype = np.int64)
+        self.currents = np.zeros(n_segments, dtype = np.int64)
 
         # pre-allocate prestates and poststates for minibatch
-        self.prestates = np.empty((self.batch_size, self.history_length) + self.dims, dtype = np.float16)
-        self.poststates = np.empty((self.batch_size, self.history_length) + self.dims, dtype = np.float16)
+        batch_shape = (self.batch_size, self.history_length) + self.dims
+        self._raw_prestates, self.prestates = \
+                            create_screen_buffers(batch_shape, screen_dtype)
+        self._raw_poststates, self.poststates = \
+                            create_screen_buffers(batch_shape, screen_dtype)
+        # offsets of the screens of a state relative to its last screen
+        self.history_offsets = np.arange(-(self.history_length - 1), 1)
+        setup_n_step(self, config)
+
+        # Set of the indexes that can be sampled: _valid_idx[:_n_valid] holds
+        # them (unordered) and _valid_pos has the position of each index in
+        # _valid_idx or -1 if it is not valid
+        self._valid_idx = np.empty(self.memory_size, dtype = np.int32)
+        self._valid_pos = np.full(self.memory_size, -1, dtype = np.int32)
+        self._n_valid = 0
+        if self.restored:
+            self.counts[:], self.currents[:] = self._pointers.T
+            self._rebuild_valid()
+    @property
+    def count(self): return int(self.counts.sum())
     def is_full(self):    
         return self.count == self.memory_size
-#    def add(self, screen, reward, action, terminal):
-    def add(self, old_screen, action, reward, screen, terminal):
-#        print("******4*********")
-#        print(old_screen.reshape(5,5))
-#        print(action, reward)
-#        print(screen.reshape(5,5))
-#        print(terminal)
-        
+
+    def flush(self):
+        """
+        Writes the memory files to disk (if the memory is on disk)
+        """
+        for array in [self.actions, self.goals, self.rewards, self.screens,
+                      self.terminals, self._pointers]:
+            if isinstance(array, np.memmap):
+                array.flush()
+    def add(self, old_screen, action, reward, screen, terminal, goal = None,
+            segment = 0):
+        """
+        params:
+            segment: int, segment of the environment that made the transition
+        """
         assert screen.shape == self.dims
         # NB! screen is post-state, after action and reward
-        self.actions[self.current] = action
-        self.rewards[self.current] = reward
-        self.screens[self.current, ...] = screen
-        self.terminals[self.current] = terminal
-        self.count = max(self.count, self.current + 1)
-        self.current = (self.current + 1) % self.memory_size
+        base = segment * self.segment_size
+        written = self.currents[segment]
+        slot = base + written
+        self.actions[slot] = action
+        if self.goals is not None:
+            self.goals[slot] = goal
+        self.rewards[slot] = reward
+        self.screens[slot, ...] = encode_screen(screen, self.screens.dtype)
+        self.terminals[slot] = terminal
+        self.counts[segment] = max(self.counts[segment], written + 1)
+        self.currents[segment] = (written + 1) % self.segment_size
+        self._pointers[segment] = self.counts[segment], self.currents[segment]
+        # Only the indexes whose state contains the written screen (or that
+        # are next to the write pointer) may have changed
+        last = min(written + self.history_length, self.segment_size - 1)
+        for index in range(base + written, base + last + 1):
+            self._set_valid(index, self._is_valid(index))
+
+    def _is_valid(self, index):
+        """
+        Same conditions that used to be checked when sampling an index
+        """
+        segment, local = divmod(index, self.segment_size)
+        count, current = self.counts[segment], self.currents[segment]
+        if not self.history_length <= local < count:
+            return False
+        # if wraps over current pointer
+        if local >= current and local - self.history_length < current:
+            return False
+        # if wraps over episode end
+        # NB! poststate (last screen) can be terminal state!
+        return not self.terminals[(index - self.history_length):index].any()
+
+    def _n_step_transitions(self, indexes):
+        """
+        Follows the transitions starting at each index (vectorized). A chain
+        stops after n_step transitions, at the end of an episode or when the
+        next transition is not in the memory (write pointer, end of the
+        array before it has been filled).
+        
+        returns:
+            discounted returns, index of the last transition of each chain
+            and discount for bootstrapping from the state after it
+        """
+        segments, local = np.divmod(indexes, self.segment_size)
+        counts = self.counts[segments, np.newaxis]
+        chains = (local[:, np.newaxis] + self.n_step_offsets) % self.segment_size
+        in_memory = (chains < counts) & \
+                            (chains != self.currents[segments, np.newaxis])
+        chains = np.minimum(chains, counts - 1) + \
+                            (segments * self.segment_size)[:, np.newaxis]
+        alive = np.empty(chains.shape, dtype = np.bool)
+        alive[:, 0] = True
+        alive[:, 1:] = ~self.terminals[chains[:, :-1]] & in_memory[:, 1:]
+        np.logical_and.accumulate(alive, axis = 1, out = alive)
+        steps = alive.sum(axis = 1)
+        returns = (self.rewards[chains] * self.discount_powers[:-1] * alive).sum(axis = 1)
+        last = chains[np.arange(len(chains)), steps - 1]
+        return returns, last, self.discount_powers[steps]
+
+    def _rebuild_valid(self):
+        """
+        Computes the set of valid indexes from scratch (vectorized version of
+        _is_valid). Used when the memory is restored from disk
+        """
+        h = self.history_length
+        valid = []
+        for segment in range(self.n_segments):
+            base = segment * self.segment_size
+            count, current = self.counts[segment], self.currents[segment]
+            indexes = np.arange(h, count)
+            terminals = np.concatenate([[0],
+                            np.cumsum(self.terminals[base:base + count])])
+            crosses_episode = terminals[indexes] - terminals[indexes - h] > 0
+            wraps = (indexes >= current) & (indexes - h < current)
+            valid.append(base + indexes[~(crosses_episode | wraps)])
+        valid = np.concatenate(valid)
+        self._n_valid = len(valid)
+        self._valid_idx[:self._n_valid] = valid
+        self._valid_pos[:] = -1
+        self._valid_pos[valid] = np.arange(self._n_valid)
+
+    def _set_valid(self, index, valid):
+        pos = self._valid_pos[index]
+        if valid and pos < 0:
+            self._valid_idx[self._n_valid] = index
+            self._valid_pos[index] = self._n_valid
+            self._n_valid += 1
+        elif not valid and pos >= 0:
+            # Move the last valid index to the position of the removed one
+            self._n_valid -= 1
+            moved = self._valid_idx[self._n_valid]
+            self._valid_idx[pos] = moved
+            self._valid_pos[moved] = pos
+            self._valid_pos[index] = -1
         
 
     def getState(self, index):
@@ -62,34 +313,35 @@ class OldReplayMemory:
         assert self.count > self.history_length, "count=%d, history_length=%d" %\
                                                     (self.count, self.history_length)
         
-        # sample random indexes
-        indexes = []
-        while len(indexes) < self.batch_size:
-            # find random index            
-            while True:
-                
-                # sample one index (ignore states wraping over
-                index = random.randint(self.history_length, self.count - 1)
-                # if wraps over current pointer, then get new one
-                if index >= self.current and index - self.history_length < self.current:
-                    continue
-                # if wraps over episode end, then get new one
-                # NB! poststate (last screen) can be terminal state!
-                if self.terminals[(index - self.history_length):index].any():
-                    continue
-                # otherwise use this index
-                break
-            
-            # NB! having index first is fastest in C-order matrices
-            self.prestates[len(indexes), ...] = self.getState(index - 1)
-            self.poststates[len(indexes), ...] = self.getState(index)
-            indexes.append(index)
+        assert self._n_valid > 0, "no valid transitions in replay memory"
+        
+        # sample random indexes among the valid ones (no rejection needed)
+        indexes = self._valid_idx[np.random.randint(self._n_valid,
+                                                    size = self.batch_size)]
+        if self.n_step > 1:
+            rewards, last, discounts = self._n_step_transitions(indexes)
+        else:
+            rewards = self.rewards[indexes]
+            last, discounts = indexes, self._discounts
+        # NB! having index first is fastest in C-order matrices
+        window = indexes[:, np.newaxis] + self.history_offsets
+        np.take(self.screens, window - 1, axis = 0, out = self._raw_prestates)
+        # The last transition of a chain may be at the start of its segment,
+        # the history of its poststate is then at the end of the segment
+        segments, local = np.divmod(last, self.segment_size)
+        window = (local[:, np.newaxis] + self.history_offsets) % \
+                    self.segment_size + (segments * self.segment_size)[:, np.newaxis]
+        np.take(self.screens, window, axis = 0, out = self._raw_poststates)
+        decode_screens(self._raw_prestates, self.prestates)
+        decode_screens(self._raw_poststates, self.poststates)
 
         actions = self.actions[indexes]
-        rewards = self.rewards[indexes]
-        terminals = self.terminals[indexes]
-        #print("sample:",self.prestates, actions, rewards, self.poststates, terminals)
-        return (self.prestates, actions, rewards, self.poststates, terminals), None, None, None, None
+        terminals = self.terminals[last]
+        batch = (self.prestates, actions, rewards, self.poststates, terminals,
+                 discounts)
+        if self.goals is not None:
+            batch += (self.goals[indexes],)
+        return batch, None, None, None, None
 
 #    def save(self):
 #        for idx, (name, array) in enumerate(
@@ -178,131 +430,514 @@ class PriorityExperienceReplay:
     '''
     Almost copy from
     https://github.com/jaara/AI-blog/blob/master/Seaquest-DDQN-PER.py
+
+    Observations are stored once in a ring of screens, as in
+    OldReplayMemory. The transition stored at slot i goes from screens[i] to
+    screens[i + 1], so consecutive transitions share their observations.
+    When the pre-state of a new transition is not the last stored screen
+    (i.e. a new episode has started) it is written to its own slot first.
+    The newest slot has no next state yet and keeps priority 0, so it is
+    never sampled. When several environments act in lockstep
+    (n_segments > 1) each one writes its own ring, a segment of the slots.
     '''
-    def __init__(self, config, screen_size):
-        max_size = config.memory_size
+    def __init__(self, config, screen_size, store_goals = False,
+                 memory_dir = None, n_segments = 1):
+        self.n_segments = n_segments
+        self.segment_size = config.memory_size // n_segments
+        max_size = self.segment_size * n_segments
         self.batch_size = config.batch_size
-  
-#    def __init__(self,
-#                max_size,
-#                window_size,
-#                input_shape):
-        self.tree = SumTree(max_size)
+        # If memory_dir is given the columns (and the priorities) are files
+        # in that directory and the memory is restored from them if they
+        # already exist
+        self.memory_dir = memory_dir
+        self.restored = is_memory_on_disk(memory_dir)
+        column = lambda *args: create_column(memory_dir, *args,
+                                             resume = self.restored)
+        # Transitions are kept in preallocated typed columns indexed by the
+        # data index of the tree leaves, the tree only stores priorities
+        self.tree = SumTree(max_size, store_data = False,
+                            tree = column('priorities', 2 * max_size - 1,
+                                          np.float64))
         self._max_size = max_size
         self._window_size = config.history_length
         self._WIDTH = screen_size#input_shape[0]
-        #self._HEIGHT = 1#input_shape[1]
+        self.dims = (self._window_size, self._WIDTH)
+        screen_dtype = get_screen_dtype(config, default = np.float32)
+        self.screens = column('screens', (max_size,) + self.dims, screen_dtype)
+        self.actions = column('actions', max_size, np.uint8)
+        self.rewards = column('rewards', max_size, np.float32)
+        self.terminals = column('terminals', max_size, np.bool)
+        # Goal pursued during each transition (only for the hDQN controller)
+        self.goals = column('goals', max_size, np.uint8) if store_goals else None
+        # write and count of each segment
+        self._pointers = column('pointers', (n_segments, 2), np.int64)
+        self.writes = np.zeros(n_segments, dtype = np.int64)
+        self.counts = np.zeros(n_segments, dtype = np.int64)
+        if self.restored:
+            self.writes[:], self.counts[:] = self._pointers.T
+
+        # pre-allocate the minibatch buffers, they are reused on every sample
+        batch_shape = (self.batch_size,) + self.dims
+        self._b_raw_old_states, self._b_old_states = \
+                            create_screen_buffers(batch_shape, screen_dtype)
+        self._b_actions = np.empty(self.batch_size, dtype = np.uint8)
+        self._b_rewards = np.empty(self.batch_size, dtype = np.float32)
+        self._b_raw_new_states, self._b_new_states = \
+                            create_screen_buffers(batch_shape, screen_dtype)
+        self._b_terminals = np.empty(self.batch_size, dtype = np.bool)
+        self._b_goals = np.empty(self.batch_size, dtype = np.uint8)
+        self._b_discounts = np.empty(self.batch_size)
+        setup_n_step(self, config)
+        # Write number of the screen of each slot, to recognize the slots
+        # overwritten after a batch was sampled (see PrefetchingMemory)
+        self.stamps = np.zeros(max_size, dtype = np.int64)
+        self._writes = 0
         self.e = 0.01
         self.a = 0.6
     @property
-    def count(self): return self.tree.total_and_count()[1]
+    def count(self): return int(self.counts.sum())
     def is_full(self): return self.count == self._max_size
+    def _last(self, segment):
+        return segment * self.segment_size + \
+                        (self.writes[segment] - 1) % self.segment_size
     def _getPriority(self, error):
         return (error + self.e) ** self.a
 
-    def add(self, old_state, action, reward, new_state, is_terminal):
-#        for o_s, a, r, n_s, i_t in zip(old_state, action, reward, new_state, is_terminal):
-            # 0.5 is the maximum error
+    def flush(self):
+        """
+        Writes the memory files to disk (if the memory is on disk)
+        """
+        for array in [self.tree.tree, self.screens, self.actions, self.rewards,
+                      self.terminals, self.goals, self._pointers]:
+            if isinstance(array, np.memmap):
+                array.flush()
+
+    def _add_screen(self, screen, segment):
+        """
+        Writes an observation in the next slot of the ring of the segment.
+        Its transition is not known yet so the slot can't be sampled
+        (priority 0). If the slot was in use, the transition it held is
+        discarded.
+        """
+        slot = segment * self.segment_size + self.writes[segment]
+        self._writes += 1
+        self.stamps[slot] = self._writes
+        self.screens[slot] = screen
+        self.tree.update(slot + self._max_size - 1, 0.)
+        self.writes[segment] = (self.writes[segment] + 1) % self.segment_size
+        self.counts[segment] = min(self.counts[segment] + 1, self.segment_size)
+
+    def add(self, old_state, action, reward, new_state, is_terminal, goal = None,
+            segment = 0):
+        """
+        params:
+            segment: int, segment of the environment that made the transition
+        """
+        old_state = encode_screen(np.reshape(old_state, self.dims),
+                                  self.screens.dtype)
+        if self.counts[segment] == 0 or \
+                not np.array_equal(self.screens[self._last(segment)], old_state):
+            # First transition of an episode
+            self._add_screen(old_state, segment)
+        # 0.5 is the maximum error
         error = 2
-        #print(reward, type(error))
         p = self._getPriority(error)
-        self.tree.add(p, data=(old_state.copy(), action, reward, new_state.copy(), is_terminal)) 
+        current = self._last(segment)
+        self.actions[current] = action
+        self.rewards[current] = reward
+        self.terminals[current] = is_terminal
+        if self.goals is not None:
+            self.goals[current] = goal
+        self.tree.update(current + self._max_size - 1, p)
+        self._add_screen(encode_screen(np.reshape(new_state, self.dims),
+                                       self.screens.dtype), segment)
+        self._pointers[segment] = self.writes[segment], self.counts[segment]
 
     def sample(self, batch_size = None, indexes=None):
-        data_batch = []
-        idx_batch = []
-        p_batch = []
         batch_size = self.batch_size
-        segment = self.tree.total_and_count()[0] / batch_size
+        sum_p, count = self.tree.total_and_count()[0], self.count
+        segment = sum_p / batch_size
+
+        # One prefix sum per segment, all the tree descents in one pass
+        s = (np.arange(batch_size) + np.random.uniform(size = batch_size)) * segment
+        idx_batch, p_batch, data_idx = self.tree.get_batch(s)
+        # Float drift in the descents can still land on a slot without a
+        # transition (priority 0, e.g. the newest one), draw those again
+        empty = p_batch <= 0
+        while empty.any():
+            s = np.random.uniform(size = empty.sum()) * sum_p
+            idx_batch[empty], p_batch[empty], data_idx[empty] = \
+                                                    self.tree.get_batch(s)
+            empty = p_batch <= 0
+
+        # NB! the returned arrays are overwritten by the next call to sample
+        if self.n_step > 1:
+            self._b_rewards[:], last, self._b_discounts[:] = \
+                                    self._n_step_transitions(data_idx)
+        else:
+            np.take(self.rewards, data_idx, out = self._b_rewards)
+            last = data_idx
+            self._b_discounts[:] = self._discounts
+        np.take(self.screens, data_idx, axis = 0, out = self._b_raw_old_states)
+        np.take(self.actions, data_idx, out = self._b_actions)
+        np.take(self.screens, self._next_slots(last), axis = 0,
+                out = self._b_raw_new_states)
+        decode_screens(self._b_raw_old_states, self._b_old_states)
+        decode_screens(self._b_raw_new_states, self._b_new_states)
+        np.take(self.terminals, last, out = self._b_terminals)
+        batch = (self._b_old_states, self._b_actions, self._b_rewards,
+                 self._b_new_states, self._b_terminals, self._b_discounts)
+        if self.goals is not None:
+            np.take(self.goals, data_idx, out = self._b_goals)
+            batch += (self._b_goals,)
+        return batch, idx_batch, p_batch, sum_p, count
+
+    def _n_step_transitions(self, data_idx):
+        """
+        Follows the transitions starting at each slot (vectorized). A chain
+        stops after n_step transitions, at the end of an episode or when the
+        next slot holds no transition (priority 0, e.g. the newest slot).
         
-        for i in range(batch_size):
-            a = segment * i
-            b = segment * (i + 1)
-
-            s = random.uniform(a, b)
-            (idx, p, data) = self.tree.get(s)
-            data_batch.append(data)
-            idx_batch.append(idx)
-            p_batch.append(p)
+        returns:
+            discounted returns, slot of the last transition of each chain
+            and discount for bootstrapping from the state after it
+        """
+        segments, local = np.divmod(data_idx, self.segment_size)
+        chains = (local[:, np.newaxis] + self.n_step_offsets) % \
+                    self.segment_size + (segments * self.segment_size)[:, np.newaxis]
+        has_transition = self.tree.tree[chains + self._max_size - 1] > 0
+        alive = np.empty(chains.shape, dtype = np.bool)
+        alive[:, 0] = True
+        alive[:, 1:] = ~self.terminals[chains[:, :-1]] & has_transition[:, 1:]
+        np.logical_and.accumulate(alive, axis = 1, out = alive)
+        steps = alive.sum(axis = 1)
+        returns = (self.rewards[chains] * self.discount_powers[:-1] * alive).sum(axis = 1)
+        last = chains[np.arange(len(chains)), steps - 1]
+        return returns, last, self.discount_powers[steps]
+
+    def _next_slots(self, slots):
+        """
+        Slots that follow the given ones in the rings of their segments
+        """
+        segments, local = np.divmod(slots, self.segment_size)
+        return segments * self.segment_size + (local + 1) % self.segment_size
 
-        zipped = list(zip(*data_batch))
-        zipped[0] = np.reshape(zipped[0], (-1, self._window_size, self._WIDTH))
-        zipped[3] = np.reshape(zipped[3], (-1, self._window_size, self._WIDTH))
-#        print(zipped[0][0].reshape(3,3))
-#        print('action',zipped[1][0])
-#        print('reward',zipped[2][0])
-#        print(zipped[3][0].reshape(3,3))
-#        print('t',zipped[4][0])
-#        print("***********")
+    def update(self, idx_list, error_list):
+        p = self._getPriority(np.asarray(error_list))
+        self.tree.update(idx_list, p)
 
-        sum_p, count = self.tree.total_and_count()
-        return zipped, idx_batch, p_batch, sum_p, count
+    def update_priorities(self, idx_list, priorities, stamps = None):
+        """
+        Same as update but with the priorities already computed (e.g. in the
+        graph of the agent)
 
-    def update(self, idx_list, error_list):
-        for idx, error in zip(idx_list, error_list):
-            p = self._getPriority(error)
-            self.tree.update(idx, p)
-            
-"""
-Copy from https://github.com/jaara/AI-blog/blob/master/SumTree.py
-More detail about the prioritized exprienced memory, the blog is attached:
-https://jaromiru.com/2016/11/07/lets-make-a-dqn-double-learning-and-prioritized-experience-replay/#fn-444-2
-"""
-import numpy
-
-class SumTree:
-    write = 0
-    count = 0
-
-    def __init__(self, capacity):
-        self.capacity = capacity
-        self.tree = numpy.zeros( 2*capacity - 1 )
-        self.data = numpy.zeros( capacity, dtype=object )
-
-    def _propagate(self, idx, change):
-        parent = (idx - 1) // 2
-
-        self.tree[parent] += change
-
-        if parent != 0:
-            self._propagate(parent, change)
-
-    def _retrieve(self, idx, s):
-        left = 2 * idx + 1
-        right = left + 1
-
-        if left >= len(self.tree):
-            return idx
-
-        if s <= self.tree[left]:
-            return self._retrieve(left, s)
+        params:
+            stamps: int array, stamps of the slots when they were sampled. If
+                given, the slots that have been overwritten since then are
+                not updated
+        """
+        idx_list = np.asarray(idx_list)
+        priorities = np.asarray(priorities)
+        if stamps is not None:
+            current = self.stamps[idx_list - self._max_size + 1] == stamps
+            idx_list, priorities = idx_list[current], priorities[current]
+        self.tree.update(idx_list, priorities)
+
+
+class SharedReplayMemory:
+    """
+    Replay memory in shared memory (multiprocessing.shared_memory) that is
+    filled by several actor processes and sampled by a single learner.
+
+    Each actor owns a range of slots that only it writes, so no locks are
+    needed. As in PriorityExperienceReplay, the transition of slot i goes
+    from screens[i] to screens[i + 1] and flags[i] tells whether slot i
+    holds a complete transition. The number of slots written by each actor
+    (its write pointer) is published after every slot, and the learner uses
+    it to discard the samples that an actor overwrote while they were being
+    gathered (they are simply drawn again).
+
+    The memory is created by the learner and passed (pickled) to the actor
+    processes, which attach to the same block and call set_actor.
+    """
+    def __init__(self, config, screen_size, store_goals = False,
+                 n_actors = 1, name = None):
+        self._args = (config, screen_size, store_goals, n_actors)
+        self.n_actors = n_actors
+        self.batch_size = config.batch_size
+        # Slots of each actor
+        self.segment_size = config.memory_size // n_actors
+        self.memory_size = self.segment_size * n_actors
+        self.dims = (config.history_length, screen_size)
+        screen_dtype = get_screen_dtype(config, default = np.float32)
+        columns = [('screens', (self.memory_size,) + self.dims, screen_dtype),
+                   ('actions', self.memory_size, np.uint8),
+                   ('rewards', self.memory_size, np.float32),
+                   ('terminals', self.memory_size, np.bool),
+                   ('flags', self.memory_size, np.bool),
+                   ('goals', self.memory_size if store_goals else 0, np.uint8),
+                   ('written', n_actors, np.int64)]
+        # Bytes of each column, rounded up to keep the columns aligned
+        nbytes = [-(-int(np.prod(shape)) * np.dtype(dtype).itemsize // 8) * 8
+                  for _, shape, dtype in columns]
+        self.owner = name is None
+        if self.owner:
+            self._shm = create_shared_memory(max(sum(nbytes), 1))
         else:
-            return self._retrieve(right, s-self.tree[left])
+            self._shm = attach_shared_memory(name)
+        self.name = self._shm.name
+        self._columns = [column for column, _, _ in columns]
+        offset = 0
+        for (column, shape, dtype), size in zip(columns, nbytes):
+            array = np.ndarray(shape, dtype = dtype, buffer = self._shm.buf,
+                               offset = offset)
+            setattr(self, column, array)
+            offset += size
+        if self.owner:
+            self.flags[:] = False
+            self.written[:] = 0
+        if not store_goals:
+            self.goals = None
+        self.actor_id = 0
+        self.restored = False
+
+        # pre-allocate the minibatch buffers, they are reused on every sample
+        batch_shape = (self.batch_size,) + self.dims
+        self._b_raw_old_states, self._b_old_states = \
+                            create_screen_buffers(batch_shape, screen_dtype)
+        self._b_raw_new_states, self._b_new_states = \
+                            create_screen_buffers(batch_shape, screen_dtype)
+        setup_n_step(self, config)
+
+    def __getstate__(self):
+        return {'args' : self._args, 'name' : self.name,
+                'actor_id' : self.actor_id}
+
+    def __setstate__(self, state):
+        config, screen_size, store_goals, n_actors = state['args']
+        self.__init__(config, screen_size, store_goals, n_actors,
+                      name = state['name'])
+        self.actor_id = state['actor_id']
+
+    def set_actor(self, actor_id):
+        """
+        Sets the range of slots written by add
+        """
+        assert 0 <= actor_id < self.n_actors
+        self.actor_id = actor_id
 
-    def total_and_count(self):
-       
-        return self.tree[0], self.count
+    @property
+    def count(self):
+        """
+        Amount of slots in use (for all the actors)
+        """
+        return int(np.minimum(self.written, self.segment_size).sum())
 
-    def add(self, p, data):
-        idx = self.write + self.capacity - 1
+    def is_full(self): return self.count == self.memory_size
 
-        self.data[self.write] = data
-        self.update(idx, p)
+    def flush(self):
+        pass
 
-        self.write += 1
-        if self.write >= self.capacity:
-            self.write = 0
-        if self.count < self.capacity:
-            self.count += 1
+    def close(self):
+        """
+        Detaches from the shared block. The learner (owner) also frees it
+        """
+        if self.owner:
+            self._shm.unlink()
+        # The columns are views of the block, they must be released first
+        for column in self._columns:
+            setattr(self, column, None)
+        self._shm.close()
+
+    def _slot(self, written):
+        return self.actor_id * self.segment_size + written % self.segment_size
+
+    def _add_screen(self, screen):
+        """
+        Writes an observation in the next slot of the actor and publishes
+        it. Its transition is not known yet so the slot can't be sampled
+        """
+        written = self.written[self.actor_id]
+        slot = self._slot(written)
+        self.flags[slot] = False
+        self.screens[slot] = screen
+        self.written[self.actor_id] = written + 1
+
+    def add(self, old_state, action, reward, new_state, is_terminal, goal = None):
+        old_state = encode_screen(np.reshape(old_state, self.dims),
+                                  self.screens.dtype)
+        written = self.written[self.actor_id]
+        last = self._slot(written - 1)
+        if written == 0 or not np.array_equal(self.screens[last], old_state):
+            # First transition of an episode
+            self._add_screen(old_state)
+            last = self._slot(written)
+        self.actions[last] = action
+        self.rewards[last] = reward
+        self.terminals[last] = is_terminal
+        if self.goals is not None:
+            self.goals[last] = goal
+        self.flags[last] = True
+        self._add_screen(encode_screen(np.reshape(new_state, self.dims),
+                                       self.screens.dtype))
+
+    def _draw(self, size, written):
+        """
+        Draws transitions uniformly among the slots of all the actors.
 
-    def update(self, idx, p):
-        change = p - self.tree[idx]
+        returns:
+            actor and write number of each transition
+        """
+        stored = np.minimum(written, self.segment_size)
+        # The newest slot of each actor has no transition
+        available = np.maximum(stored - 1, 0)
+        actors = np.searchsorted(np.cumsum(available),
+                                 np.random.randint(available.sum(), size = size),
+                                 side = 'right')
+        numbers = written[actors] - stored[actors] + \
+                        np.random.randint(available[actors])
+        return actors, numbers
 
-        self.tree[idx] = p
-        self._propagate(idx, change)
+    def sample(self):
+        written = self.written.copy()
+        assert (np.minimum(written, self.segment_size) > 1).any(), \
+                                "no transitions in replay memory"
+        actors = np.empty(self.batch_size, dtype = np.int64)
+        numbers = np.empty(self.batch_size, dtype = np.int64)
+        pending = np.arange(self.batch_size)
+        while len(pending) > 0:
+            actors[pending], numbers[pending] = self._draw(len(pending), written)
+            base = actors * self.segment_size
+            slots = base + numbers % self.segment_size
+            if self.n_step > 1:
+                rewards, last, discounts = self._n_step_transitions(
+                                            base, numbers, written[actors])
+            else:
+                rewards = self.rewards[slots]
+                last, discounts = numbers, self._discounts
+            last_slots = base + last % self.segment_size
+            next_slots = base + (last + 1) % self.segment_size
+            np.take(self.screens, slots, axis = 0, out = self._b_raw_old_states)
+            np.take(self.screens, next_slots, axis = 0,
+                    out = self._b_raw_new_states)
+            actions = self.actions[slots]
+            terminals = self.terminals[last_slots]
+            goals = self.goals[slots] if self.goals is not None else None
+            valid = self.flags[slots]
+            # Discard the samples whose slots may have been overwritten while
+            # they were gathered (the slot of the write pointer is being
+            # written now), and read the write pointers again
+            written = self.written.copy()
+            valid &= numbers > written[actors] - self.segment_size
+            pending = np.flatnonzero(~valid)
+        decode_screens(self._b_raw_old_states, self._b_old_states)
+        decode_screens(self._b_raw_new_states, self._b_new_states)
+        batch = (self._b_old_states, actions, rewards, self._b_new_states,
+                 terminals, discounts)
+        if self.goals is not None:
+            batch += (goals,)
+        return batch, None, None, None, None
+
+    def _n_step_transitions(self, base, numbers, written):
+        """
+        Follows the transitions starting at each write number (vectorized). A
+        chain stops after n_step transitions, at the end of an episode or when
+        the next slot holds no transition (e.g. the newest slot of the actor).
 
-    def get(self, s):
-        idx = self._retrieve(0, s)
-        dataIdx = idx - self.capacity + 1
+        returns:
+            discounted returns, write number of the last transition of each
+            chain and discount for bootstrapping from the state after it
+        """
+        chains = numbers[:, np.newaxis] + self.n_step_offsets
+        slots = base[:, np.newaxis] + chains % self.segment_size
+        has_transition = self.flags[slots] & \
+                                (chains < written[:, np.newaxis] - 1)
+        alive = np.empty(chains.shape, dtype = np.bool)
+        alive[:, 0] = True
+        alive[:, 1:] = ~self.terminals[slots[:, :-1]] & has_transition[:, 1:]
+        np.logical_and.accumulate(alive, axis = 1, out = alive)
+        steps = alive.sum(axis = 1)
+        returns = (self.rewards[slots] * self.discount_powers[:-1] * alive).sum(axis = 1)
+        last = chains[np.arange(len(chains)), steps - 1]
+        return returns, last, self.discount_powers[steps]
+
+
+class PrefetchingMemory:
+    """
+    Wraps a replay memory so that the batches are sampled by a background
+    thread while the learner is busy. Up to queue_size ready batches are
+    kept in a bounded queue, each with its own copy of the arrays (the
+    memories reuse their batch buffers).
+
+    add, sample and the priority updates are serialized with a lock. With a
+    prioritized memory the sampled slots are stamped, and the priorities of
+    a batch are not applied to the slots that were overwritten after it was
+    sampled (the batch was prefetched before the new transition arrived).
+    The rest of the attributes are the ones of the wrapped memory.
+    """
+    def __init__(self, memory, queue_size):
+        self.memory = memory
+        self.lock = threading.Lock()
+        self._queue = queue.Queue(maxsize = queue_size)
+        self._stop = threading.Event()
+        self._thread = None
+        self._error = None
+        # stamps of the last batch handed to the learner
+        self._stamps = None
+
+    def __getattr__(self, name):
+        return getattr(self.memory, name)
+
+    def add(self, *args, **kwargs):
+        with self.lock:
+            self.memory.add(*args, **kwargs)
+
+    def _sample(self):
+        with self.lock:
+            batch, idx, p, sum_p, count = self.memory.sample()
+            batch = tuple(np.array(column) for column in batch)
+            if idx is None:
+                return (batch, idx, p, sum_p, count), None
+            idx, p = np.array(idx), np.array(p)
+            stamps = self.memory.stamps[idx - self.memory.tree.capacity + 1]
+        return (batch, idx, p, sum_p, count), stamps
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                item = self._sample()
+                while not self._stop.is_set():
+                    try:
+                        self._queue.put(item, timeout = .1)
+                        break
+                    except queue.Full:
+                        pass
+        except Exception as e:
+            self._error = e
 
-        return (idx, self.tree[idx], self.data[dataIdx])
\ No newline at end of file
+    def sample(self):
+        """
+        Next prefetched batch. The thread is started on the first call, when
+        the memory is ready to be sampled
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target = self._run, daemon = True)
+            self._thread.start()
+        while True:
+            try:
+                sample, self._stamps = self._queue.get(timeout = .1)
+                return sample
+            except queue.Empty:
+                if self._error is not None:
+                    raise self._error
+
+    def update_priorities(self, idx_list, priorities):
+        with self.lock:
+            self.memory.update_priorities(idx_list, priorities,
+                                          stamps = self._stamps)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -2,6 +2,11 @@
 Copy from https://github.com/jaara/AI-blog/blob/master/SumTree.py
 More detail about the prioritized exprienced memory, the blog is attached:
 https://jaromiru.com/2016/11/07/lets-make-a-dqn-double-learning-and-prioritized-experience-replay/#fn-444-2
+
+The original recursive implementation has been replaced by a NumPy one that
+walks the tree level by level, so that a whole batch of prefix sums can be
+retrieved (and a whole batch of priorities updated) with a handful of
+vectorized operations instead of one Python call per node.
 """
 import numpy
 
@@ -9,39 +14,68 @@ class SumTree:
     write = 0
     count = 0
 
-    def __init__(self, capacity):
+    def __init__(self, capacity, store_data = True, tree = None):
+        """
+        params:
+            capacity: int, amount of leaves
+            store_data: bool, if False the tree only keeps priorities and the
+                caller is expected to store the data itself using the data
+                indexes (see PriorityExperienceReplay)
+            tree: float array of length 2 * capacity - 1 to hold the nodes
+                (e.g. a np.memmap). Zeros are used if it is not given
+        """
         self.capacity = capacity
-        self.tree = numpy.zeros( 2*capacity - 1 )
-        self.data = numpy.zeros( capacity, dtype=object )
-
-    def _propagate(self, idx, change):
-        parent = (idx - 1) // 2
-
-        self.tree[parent] += change
-
-        if parent != 0:
-            self._propagate(parent, change)
-
-    def _retrieve(self, idx, s):
-        left = 2 * idx + 1
-        right = left + 1
-
-        if left >= len(self.tree):
-            return idx
-
-        if s <= self.tree[left]:
-            return self._retrieve(left, s)
-        else:
-            return self._retrieve(right, s-self.tree[left])
+        self.tree = numpy.zeros( 2*capacity - 1 ) if tree is None else tree
+        self.data = numpy.zeros( capacity, dtype=object ) if store_data else None
+
+    def _propagate(self, idx):
+        """
+        Recomputes the sums of all the ancestors of the given nodes.
+
+        Parents are recomputed from their two children (instead of adding the
+        change) so repeated and duplicated indexes are handled correctly. A
+        node whose descendants live at different depths is recomputed once
+        per depth, the last time with all of its children already updated.
+        """
+        idx = numpy.unique(idx[idx != 0])
+        while len(idx) > 0:
+            parent = numpy.unique((idx - 1) // 2)
+            left = 2 * parent + 1
+            self.tree[parent] = self.tree[left] + self.tree[left + 1]
+            idx = parent[parent != 0]
+
+    def _retrieve(self, s):
+        """
+        Descends the tree for a batch of prefix sums at once
+
+        params:
+            s: float array with the prefix sums
+        returns:
+            int array with the tree index of the selected leaves
+        """
+        s = numpy.array(s, dtype = numpy.float64)
+        idx = numpy.zeros(len(s), dtype = numpy.int64)
+        while True:
+            left = 2 * idx + 1
+            # Leaves may be at two different depths if capacity is not 2^n
+            inner = left < len(self.tree)
+            if not inner.any():
+                return idx
+            left = left[inner]
+            left_sum = self.tree[left]
+            go_left = s[inner] <= left_sum
+            idx[inner] = numpy.where(go_left, left, left + 1)
+            s[inner] = numpy.where(go_left, s[inner], s[inner] - left_sum)
 
     def total_and_count(self):
-       
+
         return self.tree[0], self.count
 
-    def add(self, p, data):
+    def add(self, p, data = None):
         idx = self.write + self.capacity - 1
 
-        self.data[self.write] = data
+        if self.data is not None:
+            self.data[self.write] = data
         self.update(idx, p)
 
         self.write += 1
@@ -51,13 +85,36 @@ class SumTree:
             self.count += 1
 
     def update(self, idx, p):
-        change = p - self.tree[idx]
-
+        """
+        Sets the priority of one or more leaves and propagates the changes
+        up to the root in a single pass
+
+        params:
+            idx: int or int array, tree index of the leaves
+            p: float or float array, new priorities
+        """
+        idx = numpy.atleast_1d(numpy.asarray(idx, dtype = numpy.int64))
+        p = numpy.broadcast_to(numpy.asarray(p, dtype = numpy.float64),
+                               idx.shape)
         self.tree[idx] = p
-        self._propagate(idx, change)
+        self._propagate(idx)
+
+    def get_batch(self, s):
+        """
+        Batched version of get
+
+        params:
+            s: float array with the prefix sums
+        returns:
+            tree indexes, priorities and data indexes of the selected leaves
+        """
+        idx = self._retrieve(s)
+        data_idx = idx - self.capacity + 1
+
+        return idx, self.tree[idx], data_idx
 
     def get(self, s):
-        idx = self._retrieve(0, s)
-        dataIdx = idx - self.capacity + 1
+        idx, p, data_idx = self.get_batch([s])
+        data = self.data[data_idx[0]] if self.data is not None else data_idx[0]
 
-        return (idx, self.tree[idx], self.data[dataIdx])
\ No newline at end of file
+        return (idx[0], p[0], data)
@@ -3,6 +3,7 @@
 Auxiliary functions and configuration settings
 """
 
+import os
 import time
 import sys
 import argparse
@@ -68,6 +69,37 @@ def calc_gpu_fraction(fraction_string):
 #    print(" [*] GPU : %.4f" % fraction)
     return fraction
 
+# Index of the current Pool worker (see set_worker_index)
+worker_index = 0
+
+def set_worker_index(indexes):
+    """
+    Initializer of the workers of a multiprocessing Pool, each one takes a
+    different index
+
+    params:
+        indexes: multiprocessing.Queue with the indexes 0 ... processes - 1
+    """
+    global worker_index
+    worker_index = indexes.get()
+
+def get_worker_cores(parallel, worker):
+    """
+    Share of the available cores of the current process when `parallel`
+    experiments run at the same time in the workers of a multiprocessing
+    Pool. Each worker gets a different contiguous block of cores
+
+    params:
+        parallel: int, amount of experiments running at the same time
+        worker: int, index of the worker (0 ... parallel - 1)
+    returns:
+        list of core ids
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    per_worker = max(1, len(cores) // parallel)
+    first = (worker * per_worker) % len(cores)
+    return cores[first:first + per_worker]
+
 import numpy as np
 
 